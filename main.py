@@ -8,23 +8,45 @@ moderation commands, role management, and fun utilities for your server."""
 # -------------------------------------------------------------------------------------------------
 
 # Standard Library Imports
+import os
+import sys
 import json
+import sqlite3
 import datetime
+import zoneinfo
 import time
 import re
 import random
 from io import BytesIO
 import smtplib
 from email.message import EmailMessage
+import heapq
+import struct
+from array import array
 import asyncio
+import threading
+import functools
+from contextlib import nullcontext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-Party Library Imports
 import aiohttp
+from aiohttp import web
+from yarl import URL
 from PIL import Image, ImageFont, ImageDraw
 
+# Optional Library Imports
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Discord Library Imports
 import discord
 from discord.ext import commands
+from discord.http import Route
+from discord.message import convert_emoji_reaction
 
 # -------------------------------------------------------------------------------------------------
 # Read configuration from config.json
@@ -39,83 +61,1928 @@ def load_config():
 
 def save_config(config):
 
-    """Save the configuration to config.json"""
+    """Save the configuration to config.json"""
+
+    with open('config.json', 'w', encoding='utf-8') as configuration:
+        json.dump(config, configuration, indent=4)
+
+config = load_config()
+
+def guild_config(guild_id, section):
+
+    """Configuration section of a server, or the shared one if the server has none"""
+
+    return config.get("guilds", {}).get(str(guild_id), {}).get(section, config[section])
+
+# -------------------------------------------------------------------------------------------------
+# Instrumentation
+# -------------------------------------------------------------------------------------------------
+
+class LatencyHistogram:
+
+    """Latencies counted in fixed log-linear buckets of microseconds (HDR style)
+
+    Each power of two is split into 16 buckets, so a percentile is within about 6% of the
+    recorded value, and the histogram takes the same memory however many values it holds."""
+
+    sub_bits = 4
+    highest = (1 << 36) - 1
+
+    def __init__(self):
+        self.counts = [0] * ((36 - self.sub_bits + 1) << self.sub_bits)
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+
+        """Count a latency"""
+
+        value = min(max(int(seconds * 1000000), 0), self.highest)
+        sub_buckets = 1 << self.sub_bits
+
+        if value < sub_buckets:
+            index = value
+        else:
+            shift = value.bit_length() - self.sub_bits - 1
+            index = (shift + 1) * sub_buckets + (value >> shift) - sub_buckets
+
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+
+        """Latency (in seconds) below which a fraction of the values fall"""
+
+        sub_buckets = 1 << self.sub_bits
+        target = max(1, fraction * self.total)
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if index < sub_buckets:
+                    return index / 1000000
+                shift = index // sub_buckets - 1
+                return (((index % sub_buckets + sub_buckets + 1) << shift) - 1) / 1000000
+
+        return 0
+
+class MetricsTimer:
+
+    """Context manager recording the latency of a block"""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.started)
+
+class Metrics:
+
+    """Latency histograms and counters, collected only when enabled"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+
+        """Add a latency to a histogram"""
+
+        if not self.enabled:
+            return
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def count(self, name, amount=1):
+
+        """Add to a counter"""
+
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timer(self, name):
+
+        """Time a block (does nothing when disabled)"""
+
+        return MetricsTimer(self, name) if self.enabled else nullcontext()
+
+    def timed(self, name):
+
+        """Decorator timing a function or coroutine (left as is when disabled)"""
+
+        def decorator(function):
+            if not self.enabled:
+                return function
+
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def timed_coroutine(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        self.record(name, time.perf_counter() - started)
+
+                return timed_coroutine
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - started)
+
+            return timed_function
+
+        return decorator
+
+    def summary(self, limit=None):
+
+        """Percentiles of the busiest histograms, as (name, count, p50, p95, p99)"""
+
+        busiest = sorted(self.histograms.items(), key=lambda item: -item[1].total)[:limit]
+
+        return [
+            (
+                name,
+                histogram.total,
+                histogram.percentile(0.5),
+                histogram.percentile(0.95),
+                histogram.percentile(0.99)
+            )
+            for name, histogram in busiest
+        ]
+
+metrics_config = config.get("metrics", {})
+metrics = Metrics(metrics_config.get("enabled", False))
+
+# -------------------------------------------------------------------------------------------------
+# Read database from data.json
+# -------------------------------------------------------------------------------------------------
+
+def load_data():
+
+    """Load the database from data.json"""
+
+    with open('data.json', 'r', encoding='utf-8') as database:
+        return json.load(database)
+
+def save_data(data):
+
+    """Save the database to data.json and return its size"""
+
+    with open('data.json.tmp', 'w', encoding='utf-8') as database:
+        json.dump(data, database, indent=4)
+        database.flush()
+        os.fsync(database.fileno())
+
+    os.replace('data.json.tmp', 'data.json')
+
+    return os.path.getsize('data.json')
+
+SECTIONS = ("score", "autoroles", "reactlinks", "reactmessages", "codes", "last_daily")
+
+def section_rows(content, section):
+
+    """Map the keys of a database section to their values"""
+
+    if section == "score":
+        if isinstance(content["score"], BaseScoreStore):
+            return content["score"]
+        return {
+            entry["user"]: (entry["points"], entry.get("day")) for entry in content["score"]
+        }
+    if section == "autoroles":
+        return {role_id: True for role_id in content["roles"]["autoroles"]}
+    if section == "reactlinks":
+        return {
+            reactlink["reactrole"]: reactlink["reactemoji"]
+            for reactlink in content["roles"]["reactlinks"]
+        }
+    if section == "reactmessages":
+        if isinstance(content["roles"]["reactmessages"], dict):
+            return content["roles"]["reactmessages"]
+        return {
+            reactmessage["messageID"]: reactmessage["type"]
+            for reactmessage in content["roles"]["reactmessages"]
+        }
+    if section == "codes":
+        return content.get("codes", {})
+    if section == "last_daily":
+        return {"last_daily": content.get("last_daily", "")}
+    raise ValueError(f"Unknown database section: {section}")
+
+def content_from_rows(rows):
+
+    """Build the database from the rows of each section"""
+
+    return {
+        "roles": {
+            "autoroles": [role_id for role_id in rows["autoroles"]],
+            "reactlinks": [
+                {"reactrole": role_id, "reactemoji": emoji}
+                for role_id, emoji in rows["reactlinks"].items()
+            ],
+            "reactmessages": [
+                {"messageID": message_id, "type": message_type}
+                for message_id, message_type in rows["reactmessages"].items()
+            ]
+        },
+        "last_daily": rows["last_daily"].get("last_daily", ""),
+        "score": [
+            {"user": user_id, "points": points, "day": day}
+            for user_id, (points, day) in rows["score"].items()
+        ],
+        "codes": dict(rows["codes"])
+    }
+
+def copy_data(content):
+
+    """Copy the database so that it can be written while it keeps changing"""
+
+    return content_from_rows({section: section_rows(content, section) for section in SECTIONS})
+
+def empty_guild():
+
+    """Database of a server without any entry"""
+
+    return {
+        "roles": {"autoroles": [], "reactlinks": [], "reactmessages": []},
+        "last_daily": "",
+        "score": [],
+        "codes": {}
+    }
+
+def split_guilds(content):
+
+    """Database of each server, indexed by server id
+
+    A data.json written before servers were partitioned belongs to the configured server."""
+
+    if "guilds" not in content:
+        return {config["bot"]["server"]: content}
+
+    return {int(guild_id): guild for guild_id, guild in content["guilds"].items()}
+
+def join_guilds(guilds):
+
+    """Copy the database of each server into a single document"""
+
+    return {"guilds": {str(guild_id): copy_data(guild) for guild_id, guild in guilds.items()}}
+
+# Score store -------------------------------------------------------------------------------------
+
+class DemotionIndex:
+
+    """Active members ordered by the day their score drops below the threshold"""
+
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+
+    def schedule(self, user_id, day):
+
+        """Set (or clear, with None) the demotion day of a member"""
+
+        if day is None:
+            self.due.pop(user_id, None)
+            return
+
+        if self.due.get(user_id) == day:
+            return
+
+        self.due[user_id] = day
+        heapq.heappush(self.heap, (day, user_id))
+
+        if len(self.heap) > 2 * len(self.due) + 1024:
+            self.heap = [(due, user) for user, due in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, today):
+
+        """Remove and return the members due for demotion by today"""
+
+        users = []
+
+        while self.heap and self.heap[0][0] <= today:
+            day, user_id = heapq.heappop(self.heap)
+            if self.due.get(user_id) == day:
+                del self.due[user_id]
+                users.append(user_id)
+
+        return users
+
+class ScoreRanking:
+
+    """Order statistics of member scores, for leaderboards
+
+    Members below the limit are ranked by points + day * daily, which decay does not change:
+    their current points are that key minus today * daily (0 at most). Members at the limit
+    are always on top and are kept apart. Keys are counted in a Fenwick tree over a window
+    starting at the key of the day the window was built."""
+
+    def __init__(self, limit, daily):
+        self.limit = limit
+        self.daily = daily
+        self.base = 0
+        self.size = 0
+        self.tree = []
+        self.keys = {}
+        self.buckets = {}
+        self.exempt = set()
+
+    def rebuild(self, base, highest):
+
+        """Move the window so that it covers keys from base up to highest"""
+
+        self.base = base
+        self.size = max(2 * (self.limit + 1), highest - base + 1)
+        self.tree = [0] * (self.size + 1)
+
+        buckets = self.buckets
+        self.buckets = {}
+
+        for user_ids in buckets.values():
+            for user_id in user_ids:
+                key = max(self.keys[user_id], base)
+                self.keys[user_id] = key
+                self.buckets.setdefault(key, set()).add(user_id)
+                self.count(key, 1)
+
+    def count(self, key, delta):
+
+        """Add delta to the count of a key"""
+
+        position = key - self.base + 1
+        while position <= self.size:
+            self.tree[position] += delta
+            position += position & -position
+
+    def count_above(self, key):
+
+        """Number of ranked members (not at the limit) with a higher key"""
+
+        position = min(key - self.base + 1, self.size)
+        below = 0
+        while position > 0:
+            below += self.tree[position]
+            position -= position & -position
+        return len(self.keys) - below
+
+    def update(self, user_id, points, day):
+
+        """Index the stored points and day of a member"""
+
+        self.discard(user_id)
+
+        if points >= self.limit:
+            self.exempt.add(user_id)
+            return
+
+        key = points + day * self.daily
+
+        if key >= self.base + self.size:
+            self.rebuild(day * self.daily, key)
+        key = max(key, self.base)
+
+        self.keys[user_id] = key
+        self.buckets.setdefault(key, set()).add(user_id)
+        self.count(key, 1)
+
+    def discard(self, user_id):
+
+        """Remove a member from the index"""
+
+        self.exempt.discard(user_id)
+        key = self.keys.pop(user_id, None)
+
+        if key is not None:
+            self.buckets[key].discard(user_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+            self.count(key, -1)
+
+    def rank(self, user_id, today):
+
+        """Rank of a member (1 for the top score, ties share a rank)"""
+
+        if user_id in self.exempt:
+            return 1
+
+        key = max(self.keys[user_id], today * self.daily)
+        return len(self.exempt) + self.count_above(key) + 1
+
+    def top(self, amount, today):
+
+        """Pairs of user id and points of the highest scores"""
+
+        leaders = [(user_id, self.limit) for user_id in sorted(self.exempt)[:amount]]
+        floor = today * self.daily
+
+        for key in sorted(self.buckets, reverse=True):
+            if len(leaders) >= amount:
+                break
+            for user_id in sorted(self.buckets[key]):
+                leaders.append((user_id, max(0, key - floor)))
+
+        return leaders[:amount]
+
+class ScoreHistory:
+
+    """Daily points of each member, in fixed-size ring buffers
+
+    Days without a record are filled in from the last one with the same decay as the scores."""
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.typecode = 'H' if limit <= 0xFFFF else 'I'
+        self.highest = 0xFFFF if self.typecode == 'H' else 0xFFFFFFFF
+        self.empty = array(self.typecode, [0]) * size
+        self.series = {}
+        self.last = {}
+
+    def record(self, user_id, day, points, projected):
+
+        """Set the points of a member for a day"""
+
+        series = self.series.get(user_id)
+
+        if series is None:
+            series = self.series[user_id] = self.empty[:]
+        else:
+            last = self.last[user_id]
+            if day < last:
+                return
+
+            previous = series[last % self.size]
+            for gap in range(max(last + 1, day - self.size + 1), day):
+                series[gap % self.size] = projected(previous, last, gap)
+
+        series[day % self.size] = min(points, self.highest)
+        self.last[user_id] = day
+
+    def read(self, user_id, today, amount, projected):
+
+        """Points of a member for each of the last days, oldest first"""
+
+        series = self.series.get(user_id)
+        if series is None:
+            return [0] * amount
+
+        last = self.last[user_id]
+        previous = series[last % self.size]
+        values = []
+
+        for day in range(today - amount + 1, today + 1):
+            if day > last:
+                values.append(projected(previous, last, day))
+            elif day <= last - self.size:
+                values.append(0)
+            else:
+                values.append(series[day % self.size])
+
+        return values
+
+    def snapshot(self):
+
+        """Serialize the ring buffers"""
+
+        header = struct.pack("<4sHc", b"SHv1", self.size, self.typecode.encode())
+
+        return header + b"".join(
+            struct.pack("<qi", user_id, self.last[user_id]) + series.tobytes()
+            for user_id, series in self.series.items()
+        )
+
+    def restore(self, snapshot):
+
+        """Load ring buffers serialized with the same size and type"""
+
+        magic, size, typecode = struct.unpack_from("<4sHc", snapshot)
+
+        if magic != b"SHv1" or size != self.size or typecode.decode() != self.typecode:
+            print("Score history format changed, starting a new history.")
+            return
+
+        offset = struct.calcsize("<4sHc")
+        length = self.size * self.empty.itemsize
+
+        while offset < len(snapshot):
+            user_id, last = struct.unpack_from("<qi", snapshot, offset)
+            offset += struct.calcsize("<qi")
+
+            series = array(self.typecode)
+            series.frombytes(snapshot[offset:offset + length])
+            offset += length
+
+            self.series[user_id] = series
+            self.last[user_id] = last
+
+class BaseScoreStore:
+
+    """Member scores with the day of their last update, indexed by user id
+
+    Points decay by "daily" for every day since that update, except for members at the limit.
+    With lazy decay, this is only applied when a score is read or written."""
+
+    def __init__(self, settings, today):
+        self.daily = settings["daily"]
+        self.limit = settings["limit"]
+        self.threshold = settings["threshold"]
+        self.lazy = settings.get("decay", "daily") == "lazy"
+        self.today = today
+        self.demotions = DemotionIndex()
+        self.ranking = ScoreRanking(self.limit, self.daily)
+        self.history = ScoreHistory(settings.get("history_days", 90), self.limit)
+        self.day_names = {}
+
+    @classmethod
+    def from_entries(cls, entries, settings, last_daily):
+
+        """Build the store from the on-disk list of {"user", "points", "day"} entries"""
+
+        if last_daily:
+            today = datetime.date.fromisoformat(last_daily).toordinal()
+        else:
+            today = datetime.date.today().toordinal()
+
+        store = cls(settings, today)
+
+        for entry in entries:
+            day = entry.get("day")
+            day = datetime.date.fromisoformat(day).toordinal() if day else today
+            store.store_row(entry["user"], entry["points"], day)
+
+        return store
+
+    def day_name(self, day):
+
+        """ISO date of a day ordinal"""
+
+        name = self.day_names.get(day)
+        if name is None:
+            name = self.day_names[day] = datetime.date.fromordinal(day).isoformat()
+        return name
+
+    def projected(self, points, day, today=None):
+
+        """Points of a member after the decay since their last update"""
+
+        if today is None:
+            today = self.today
+
+        if points >= self.limit:
+            return self.limit
+        if day >= today:
+            return points
+        return max(0, points - (today - day) * self.daily)
+
+    def demotion_day(self, points, day):
+
+        """Day on which decay takes an active member below the threshold"""
+
+        if not self.lazy or self.daily <= 0:
+            return None
+        if points >= self.limit or points < self.threshold:
+            return None
+        return day + (points - self.threshold) // self.daily + 1
+
+    def get(self, user_id, default=0):
+
+        """Points of a member"""
+
+        row = self.load_row(user_id)
+        return default if row is None else self.projected(*row)
+
+    def set(self, user_id, points):
+
+        """Set the points of a member and return the previous value"""
+
+        row = self.load_row(user_id)
+        self.store_row(user_id, points, self.today)
+        self.history.record(user_id, self.today, points, self.projected)
+        return None if row is None else self.projected(*row)
+
+    def add(self, user_id, amount, limit):
+
+        """Add points to a member without going over the limit"""
+
+        row = self.load_row(user_id)
+
+        if row is None:
+            previous = None
+            points = min(amount, limit)
+        else:
+            previous = self.projected(*row)
+            points = min(previous + amount, limit)
+
+        self.store_row(user_id, points, self.today)
+        self.history.record(user_id, self.today, points, self.projected)
+        return previous
+
+    def rank(self, user_id):
+
+        """Leaderboard rank of a member"""
+
+        return self.ranking.rank(user_id, self.today)
+
+    def top(self, amount):
+
+        """Pairs of user id and points of the highest scores"""
+
+        return self.ranking.top(amount, self.today)
+
+    def points_history(self, user_id, amount):
+
+        """Points of a member for each of the last days, oldest first"""
+
+        # Scores loaded from disk, or changed after the last history save, have no ring yet
+        row = self.load_row(user_id)
+        if row is not None:
+            points, day = row
+            if self.history.last.get(user_id, day - 1) < day:
+                self.history.record(user_id, day, points, self.projected)
+
+        return self.history.read(user_id, self.today, amount, self.projected)
+
+    def crossed_threshold(self, previous, points):
+
+        """Check if a score change moves a member to the other role"""
+
+        if previous is None:
+            return True
+
+        return (previous >= self.threshold) != (points >= self.threshold)
+
+    def advance(self, today):
+
+        """Move to a new day without touching scores (lazy decay)
+
+        Returns the members whose score just dropped below the threshold."""
+
+        self.today = today
+        return self.demotions.pop_due(today)
+
+class ScoreStore(BaseScoreStore):
+
+    """Member scores in dicts indexed by user id"""
+
+    def __init__(self, settings, today):
+        super().__init__(settings, today)
+        self.points = {}
+        self.days = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, user_id):
+        return user_id in self.points
+
+    def __getitem__(self, user_id):
+        return self.points[user_id], self.day_name(self.days[user_id])
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def keys(self):
+
+        """User ids"""
+
+        return self.points.keys()
+
+    def items(self):
+
+        """Pairs of user id and stored (points, day)"""
+
+        return ((user_id, self[user_id]) for user_id in self.points)
+
+    def load_row(self, user_id):
+
+        """Stored points and day of a member"""
+
+        points = self.points.get(user_id)
+        return None if points is None else (points, self.days[user_id])
+
+    def store_row(self, user_id, points, day):
+
+        """Store the points and day of a member"""
+
+        self.points[user_id] = points
+        self.days[user_id] = day
+        self.demotions.schedule(user_id, self.demotion_day(points, day))
+        self.ranking.update(user_id, points, day)
+
+    def decay(self, today):
+
+        """Apply the decay up to today and return the members who changed role"""
+
+        moved = set()
+
+        for user_id, points in self.points.items():
+            day = self.days[user_id]
+            before = self.projected(points, day)
+            after = self.projected(points, day, today)
+
+            self.points[user_id] = after
+            self.days[user_id] = today
+
+            if (before >= self.threshold) != (after >= self.threshold):
+                moved.add(user_id)
+
+        self.today = today
+        return moved
+
+class ColumnarScoreStore(BaseScoreStore):
+
+    """Member scores as parallel NumPy arrays of user ids, points and days"""
+
+    def __init__(self, settings, today):
+        super().__init__(settings, today)
+        self.user_ids = numpy.zeros(1024, dtype=numpy.int64)
+        self.points = numpy.zeros(1024, dtype=numpy.int64)
+        self.days = numpy.zeros(1024, dtype=numpy.int64)
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __getitem__(self, user_id):
+        row = self.index[user_id]
+        return int(self.points[row]), self.day_name(int(self.days[row]))
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+
+        """User ids"""
+
+        return self.index.keys()
+
+    def items(self):
+
+        """Pairs of user id and stored (points, day)"""
+
+        size = len(self.index)
+
+        return (
+            (user_id, (points, self.day_name(day)))
+            for user_id, points, day in zip(
+                self.user_ids[:size].tolist(),
+                self.points[:size].tolist(),
+                self.days[:size].tolist()
+            )
+        )
+
+    def load_row(self, user_id):
+
+        """Stored points and day of a member"""
+
+        row = self.index.get(user_id)
+        return None if row is None else (int(self.points[row]), int(self.days[row]))
+
+    def store_row(self, user_id, points, day):
+
+        """Store the points and day of a member"""
+
+        row = self.index.get(user_id)
+
+        if row is None:
+            row = self.index[user_id] = len(self.index)
+
+            if row == len(self.user_ids):
+                self.user_ids = numpy.concatenate((self.user_ids, numpy.zeros_like(self.user_ids)))
+                self.points = numpy.concatenate((self.points, numpy.zeros_like(self.points)))
+                self.days = numpy.concatenate((self.days, numpy.zeros_like(self.days)))
+
+            self.user_ids[row] = user_id
+
+        self.points[row] = points
+        self.days[row] = day
+        self.demotions.schedule(user_id, self.demotion_day(points, day))
+        self.ranking.update(user_id, points, day)
+
+    def projected_column(self, points, days, today):
+
+        """Points of every member after the decay up to a day"""
+
+        elapsed = numpy.maximum(today - days, 0)
+        decayed = numpy.maximum(points - elapsed * self.daily, 0)
+
+        return numpy.where(points >= self.limit, self.limit, decayed)
+
+    def decay(self, today):
+
+        """Apply the decay up to today and return the members who changed role"""
+
+        size = len(self.index)
+        points = self.points[:size]
+        days = self.days[:size]
+
+        was_active = self.projected_column(points, days, self.today) >= self.threshold
+        points[:] = self.projected_column(points, days, today)
+        days[:] = today
+        self.today = today
+
+        return set(self.user_ids[:size][was_active != (points >= self.threshold)].tolist())
+
+# Reactrole index ---------------------------------------------------------------------------------
+
+class ReactRoleIndex:
+
+    """Reactrole messages and links of a server, indexed by message id, emoji and role id
+
+    Reactrole messages are kept as a dict of message id to type, which replaces the stored
+    list (it is written back as a list). Changes go through this class so that the stored
+    links and the indexes stay in step."""
+
+    def __init__(self, roles):
+        self.roles = roles
+        self.message_types = roles["reactmessages"] = {
+            reactmessage["messageID"]: reactmessage["type"]
+            for reactmessage in roles["reactmessages"]
+        }
+        self.role_ids = {
+            reactlink["reactemoji"]: reactlink["reactrole"] for reactlink in roles["reactlinks"]
+        }
+        self.emojis = {
+            reactlink["reactrole"]: reactlink["reactemoji"] for reactlink in roles["reactlinks"]
+        }
+
+    def link(self, role_id, emoji):
+
+        """Link a role to an emoji"""
+
+        self.roles["reactlinks"].append({"reactrole": role_id, "reactemoji": emoji})
+        self.role_ids[emoji] = role_id
+        self.emojis[role_id] = emoji
+
+    def unlink(self, role_id):
+
+        """Unlink a role from its emoji"""
+
+        self.role_ids.pop(self.emojis.pop(role_id), None)
+        self.roles["reactlinks"] = [
+            reactlink for reactlink in self.roles["reactlinks"] if reactlink["reactrole"] != role_id
+        ]
+
+    def clear_links(self):
+
+        """Unlink every role"""
+
+        self.roles["reactlinks"] = []
+        self.role_ids.clear()
+        self.emojis.clear()
+
+    def add_message(self, message_id, message_type):
+
+        """Track a reactrole message"""
+
+        self.message_types[message_id] = message_type
+
+    def remove_messages(self, message_ids):
+
+        """Stop tracking deleted messages and return those that were reactrole messages"""
+
+        removed = self.message_types.keys() & message_ids
+
+        for message_id in removed:
+            del self.message_types[message_id]
+
+        return removed
+
+# JSON backend ------------------------------------------------------------------------------------
+
+class JsonBackend:
+
+    """Database stored as a single JSON document"""
+
+    def load(self):
+        return split_guilds(load_data())
+
+    def snapshot(self, guilds, changes):
+        return join_guilds(guilds)
+
+    def write(self, snapshot):
+        return save_data(snapshot)
+
+# SQLite backend ----------------------------------------------------------------------------------
+
+class SqliteBackend:
+
+    """Database stored as SQLite tables, one row per entry and server"""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS score (
+            guild INTEGER NOT NULL, user INTEGER NOT NULL, points INTEGER NOT NULL, day TEXT,
+            PRIMARY KEY (guild, user)
+        );
+        CREATE TABLE IF NOT EXISTS autoroles (
+            guild INTEGER NOT NULL, role INTEGER NOT NULL, UNIQUE (guild, role)
+        );
+        CREATE TABLE IF NOT EXISTS reactlinks (
+            guild INTEGER NOT NULL, role INTEGER NOT NULL, emoji TEXT NOT NULL,
+            UNIQUE (guild, role)
+        );
+        CREATE TABLE IF NOT EXISTS reactmessages (
+            guild INTEGER NOT NULL, message INTEGER NOT NULL, type TEXT NOT NULL,
+            UNIQUE (guild, message)
+        );
+        CREATE TABLE IF NOT EXISTS codes (
+            guild INTEGER NOT NULL, user TEXT NOT NULL, code TEXT NOT NULL,
+            expiration REAL NOT NULL, PRIMARY KEY (guild, user)
+        );
+        CREATE TABLE IF NOT EXISTS guild_meta (
+            guild INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (guild, key)
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    queries = {
+        "score": "SELECT guild, user, points, day FROM score",
+        "autoroles": "SELECT guild, role, 1 FROM autoroles ORDER BY rowid",
+        "reactlinks": "SELECT guild, role, emoji FROM reactlinks ORDER BY rowid",
+        "reactmessages": "SELECT guild, message, type FROM reactmessages ORDER BY rowid",
+        "codes": "SELECT guild, user, code, expiration FROM codes",
+        "last_daily": "SELECT guild, key, value FROM guild_meta WHERE key = 'last_daily'"
+    }
+
+    legacy_queries = {
+        "score": "SELECT ?, user, points, {day} FROM score",
+        "autoroles": "SELECT ?, role, 1 FROM autoroles ORDER BY rowid",
+        "reactlinks": "SELECT ?, role, emoji FROM reactlinks ORDER BY rowid",
+        "reactmessages": "SELECT ?, message, type FROM reactmessages ORDER BY rowid",
+        "codes": "SELECT ?, user, code, expiration FROM codes",
+        "last_daily": "SELECT ?, key, value FROM meta WHERE key = 'last_daily'"
+    }
+
+    upserts = {
+        "score": "INSERT INTO score VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT(guild, user) DO UPDATE SET "
+                 "points = excluded.points, day = excluded.day",
+        "autoroles": "INSERT OR IGNORE INTO autoroles VALUES (?, ?)",
+        "reactlinks": "INSERT INTO reactlinks VALUES (?, ?, ?) "
+                      "ON CONFLICT(guild, role) DO UPDATE SET emoji = excluded.emoji",
+        "reactmessages": "INSERT INTO reactmessages VALUES (?, ?, ?) "
+                         "ON CONFLICT(guild, message) DO UPDATE SET type = excluded.type",
+        "codes": "INSERT INTO codes VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT(guild, user) DO UPDATE SET "
+                 "code = excluded.code, expiration = excluded.expiration",
+        "last_daily": "INSERT INTO guild_meta VALUES (?, ?, ?) "
+                      "ON CONFLICT(guild, key) DO UPDATE SET value = excluded.value"
+    }
+
+    deletes = {
+        "score": "DELETE FROM score WHERE guild = ? AND user = ?",
+        "autoroles": "DELETE FROM autoroles WHERE guild = ? AND role = ?",
+        "reactlinks": "DELETE FROM reactlinks WHERE guild = ? AND role = ?",
+        "reactmessages": "DELETE FROM reactmessages WHERE guild = ? AND message = ?",
+        "codes": "DELETE FROM codes WHERE guild = ? AND user = ?",
+        "last_daily": "DELETE FROM guild_meta WHERE guild = ? AND key = ?"
+    }
+
+    clears = {
+        "score": "DELETE FROM score WHERE guild = ?",
+        "autoroles": "DELETE FROM autoroles WHERE guild = ?",
+        "reactlinks": "DELETE FROM reactlinks WHERE guild = ?",
+        "reactmessages": "DELETE FROM reactmessages WHERE guild = ?",
+        "codes": "DELETE FROM codes WHERE guild = ?",
+        "last_daily": "DELETE FROM guild_meta WHERE guild = ? AND key = 'last_daily'"
+    }
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.upgrade()
+        self.connection.executescript(self.schema)
+
+    @staticmethod
+    def row_values(section, key, value):
+
+        """Flatten a database entry into SQL parameters"""
+
+        if section == "autoroles":
+            return (key,)
+        if section == "score":
+            return (key, value[0], value[1])
+        if section == "codes":
+            return (key, value["code"], value["expiration"])
+        return (key, value)
+
+    @staticmethod
+    def row_value(section, values):
+
+        """Database entry of the columns following the key"""
+
+        if section == "score":
+            return tuple(values)
+        if section == "codes":
+            return {"code": values[0], "expiration": values[1]}
+        return values[0]
+
+    def read_rows(self, queries, parameters=()):
+
+        """Rows of each section of each server"""
+
+        guilds = {}
+
+        for section, query in queries.items():
+            for guild_id, key, *values in self.connection.execute(query, parameters):
+                if guild_id not in guilds:
+                    guilds[guild_id] = {name: {} for name in SECTIONS}
+                guilds[guild_id][section][key] = self.row_value(section, values)
+
+        return guilds
+
+    def insert_rows(self, guilds):
+
+        """Insert the rows of each section of each server"""
+
+        for guild_id, rows in guilds.items():
+            for section in SECTIONS:
+                self.connection.executemany(self.upserts[section], [
+                    (guild_id,) + self.row_values(section, key, value)
+                    for key, value in rows[section].items()
+                ])
+
+    def upgrade(self):
+
+        """Move a database from before servers were partitioned to the configured server"""
+
+        columns = [column[1] for column in self.connection.execute("PRAGMA table_info(score)")]
+
+        if not columns or "guild" in columns:
+            return
+
+        queries = dict(self.legacy_queries)
+        queries["score"] = queries["score"].format(day="day" if "day" in columns else "NULL")
+        guilds = self.read_rows(queries, (config["bot"]["server"],))
+
+        with self.connection:
+            self.connection.execute("BEGIN")
+            for table in ("score", "autoroles", "reactlinks", "reactmessages", "codes"):
+                self.connection.execute(f"DROP TABLE {table}")
+            self.connection.execute("DELETE FROM meta WHERE key = 'last_daily'")
+            for statement in self.schema.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+            self.insert_rows(guilds)
+
+        print("Moved the SQLite database to the configured server.")
+
+    def migrate(self):
+
+        """Import data.json into an empty database"""
+
+        migrated = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'migrated'"
+        ).fetchone()
+
+        if migrated or not os.path.exists('data.json'):
+            return
+
+        with self.connection:
+            self.insert_rows({
+                guild_id: {section: section_rows(guild, section) for section in SECTIONS}
+                for guild_id, guild in split_guilds(load_data()).items()
+            })
+            self.connection.execute("INSERT INTO meta VALUES ('migrated', '1')")
+
+        print("Migrated data.json to SQLite.")
+
+    def load(self):
+        self.migrate()
+
+        return {
+            guild_id: content_from_rows(rows)
+            for guild_id, rows in self.read_rows(self.queries).items()
+        }
+
+    def snapshot(self, guilds, changes):
+        statements = []
+
+        for (guild_id, section), keys in changes.items():
+            rows = section_rows(guilds[guild_id], section)
+
+            if None in keys:
+                statements.append((self.clears[section], (guild_id,)))
+                keys = rows.keys()
+
+            for key in keys:
+                if key in rows:
+                    statements.append((
+                        self.upserts[section],
+                        (guild_id,) + self.row_values(section, key, rows[key])
+                    ))
+                else:
+                    statements.append((self.deletes[section], (guild_id, key)))
+
+        return statements
+
+    def write(self, snapshot):
+        with self.connection:
+            for statement, parameters in snapshot:
+                self.connection.execute(statement, parameters)
+
+        return sum(
+            len(str(value)) for _, parameters in snapshot for value in parameters
+        )
+
+# Journal backend ---------------------------------------------------------------------------------
+
+class JournalBackend:
+
+    """Database stored as a data.json snapshot plus an append-only journal"""
+
+    def __init__(self, path, compact_lines):
+        self.path = path
+        self.compact_lines = compact_lines
+        self.lines = 0
+
+    def replay(self, guilds):
+
+        """Apply the journal entries to the rows of each section of each server"""
+
+        count = 0
+        offset = 0
+
+        with open(self.path, 'rb+') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    journal.truncate(offset)
+                    print(f"Dropped a torn entry at the end of {self.path}.")
+                    break
+
+                guild_id = entry.get("g", config["bot"]["server"])
+                if guild_id not in guilds:
+                    guilds[guild_id] = {name: {} for name in SECTIONS}
+
+                section = guilds[guild_id][entry["s"]]
+                if "k" not in entry:
+                    section.clear()
+                elif "v" in entry:
+                    section[entry["k"]] = entry["v"]
+                else:
+                    section.pop(entry["k"], None)
+
+                offset += len(line)
+                count += 1
+
+        return count
+
+    def load(self):
+        guilds = split_guilds(load_data())
+
+        if not os.path.exists(self.path):
+            return guilds
+
+        rows = {
+            guild_id: {section: dict(section_rows(guild, section)) for section in SECTIONS}
+            for guild_id, guild in guilds.items()
+        }
+
+        if self.replay(rows):
+            guilds = {guild_id: content_from_rows(guild) for guild_id, guild in rows.items()}
+            save_data(join_guilds(guilds))
+
+        os.remove(self.path)
+
+        return guilds
+
+    def snapshot(self, guilds, changes):
+        entries = []
+
+        for (guild_id, section), keys in changes.items():
+            rows = section_rows(guilds[guild_id], section)
+
+            if None in keys:
+                entries.append({"g": guild_id, "s": section})
+                keys = rows.keys()
+
+            for key in keys:
+                if key in rows:
+                    entries.append({"g": guild_id, "s": section, "k": key, "v": rows[key]})
+                else:
+                    entries.append({"g": guild_id, "s": section, "k": key})
+
+        self.lines += len(entries)
+
+        if self.lines < self.compact_lines:
+            return entries, None
+
+        self.lines = 0
+        return entries, join_guilds(guilds)
+
+    def write(self, snapshot):
+        entries, compacted = snapshot
+        text = "".join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+
+        with open(self.path, 'a', encoding='utf-8') as journal:
+            journal.write(text)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        size = len(text.encode())
+
+        if compacted is not None:
+            size += save_data(compacted)
+            os.remove(self.path)
+
+        return size
+
+# Write-behind store ------------------------------------------------------------------------------
+
+class DataStore:
+
+    """Write-behind store for the database of each server"""
+
+    def __init__(self, backend, score_store, flush_interval, flush_mutations):
+        self.backend = backend
+        self.score_store = score_store
+        self.guilds = {
+            guild_id: self.prepare(guild_id, guild) for guild_id, guild in backend.load().items()
+        }
+        self.flush_interval = flush_interval / 1000
+        self.flush_mutations = flush_mutations
+        self.changes = {}
+        self.mutations = 0
+        self.flush_handle = None
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="datastore")
+        self.writing = None
+        self.closed = False
+
+    def prepare(self, guild_id, guild):
+
+        """Load the scores of a server into its score store and index its reactroles"""
+
+        guild["score"] = self.score_store.from_entries(
+            guild["score"], guild_config(guild_id, "score"), guild.get("last_daily")
+        )
+        guild["reactroles"] = ReactRoleIndex(guild["roles"])
+        return guild
+
+    def guild(self, guild_id):
+
+        """Database of a server (created empty on first use)"""
+
+        guild = self.guilds.get(guild_id)
+
+        if guild is None:
+            guild = self.guilds[guild_id] = self.prepare(guild_id, empty_guild())
+
+        return guild
+
+    def mark_dirty(self, guild_id, section, key=None):
+
+        """Record a mutation and schedule a flush (no key: whole section)"""
+
+        self.changes.setdefault((guild_id, section), set()).add(key)
+        self.mutations += 1
+
+        loop = asyncio.get_running_loop()
+
+        if self.mutations == self.flush_mutations:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+            self.flush_handle = loop.call_soon(self.flush)
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+
+        """Snapshot pending mutations and hand them to the writer thread"""
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if not self.mutations or self.writing is not None:
+            return
+
+        snapshot = self.backend.snapshot(self.guilds, self.changes)
+        self.writing = self.changes
+        self.changes = {}
+        self.mutations = 0
+
+        future = asyncio.get_running_loop().run_in_executor(self.writer, self.write, snapshot)
+        future.add_done_callback(self.written)
+
+    def write(self, snapshot):
+
+        """Write a snapshot with the backend (writer thread)
+
+        Returns the bytes written and the duration, which are recorded back on the loop: the
+        metrics are not shared with this thread."""
+
+        started = time.perf_counter()
+        size = self.backend.write(snapshot)
+        return size, time.perf_counter() - started
+
+    def written(self, future):
+
+        """Requeue a failed write and pick up mutations made meanwhile"""
+
+        loop = asyncio.get_running_loop()
+
+        if future.exception() is not None:
+            print(f"An error occurred while saving data: {future.exception()}")
+
+            for change, keys in self.writing.items():
+                self.changes.setdefault(change, set()).update(keys)
+                self.mutations += len(keys)
+        else:
+            size, seconds = future.result()
+            metrics.count("persisted_bytes", size)
+            metrics.record("persist", seconds)
+
+        self.writing = None
+
+        if self.mutations and self.flush_handle is None:
+            if future.exception() is not None:
+                self.flush_handle = loop.call_later(self.flush_interval, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+
+    def close(self):
+
+        """Wait for the writer thread and write what is left (shutdown)"""
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        self.writer.shutdown(wait=True)
+
+        if self.writing is not None:
+            for change, keys in self.writing.items():
+                self.changes.setdefault(change, set()).update(keys)
+                self.mutations += len(keys)
+            self.writing = None
+
+        if self.mutations:
+            self.write(self.backend.snapshot(self.guilds, self.changes))
+            self.changes = {}
+            self.mutations = 0
+
+        self.closed = True
+
+storage_config = config.get("storage", {})
+
+if storage_config.get("backend", "json") == "sqlite":
+    storage_backend = SqliteBackend(storage_config.get("sqlite_path", "data.db"))
+elif storage_config.get("backend", "json") == "journal":
+    storage_backend = JournalBackend(
+        storage_config.get("journal_path", "data.journal"),
+        storage_config.get("compact_lines", 10000)
+    )
+else:
+    storage_backend = JsonBackend()
+
+if storage_config.get("scores", "dict") == "columnar":
+    if numpy is None:
+        print("NumPy is not installed, falling back to the dict score store.")
+        score_store_class = ScoreStore
+    else:
+        score_store_class = ColumnarScoreStore
+else:
+    score_store_class = ScoreStore
+
+store = DataStore(
+    storage_backend,
+    score_store_class,
+    storage_config.get("flush_interval", 2000),
+    storage_config.get("flush_mutations", 100)
+)
+
+# Score history -----------------------------------------------------------------------------------
+
+HISTORY_PATH = storage_config.get("history_path", "history.bin")
+
+def history_snapshot():
+
+    """Serialize the score history of each server"""
+
+    chunks = [b"GHv1"]
+
+    for guild_id, guild in store.guilds.items():
+        snapshot = guild["score"].history.snapshot()
+        chunks.append(struct.pack("<qI", guild_id, len(snapshot)) + snapshot)
+
+    return b"".join(chunks)
+
+def restore_history(snapshot):
+
+    """Load the score history of each server
+
+    A history written before servers were partitioned belongs to the configured server."""
+
+    if snapshot.startswith(b"SHv1"):
+        store.guild(config["bot"]["server"])["score"].history.restore(snapshot)
+        return
+
+    if not snapshot.startswith(b"GHv1"):
+        print("Score history format changed, starting a new history.")
+        return
+
+    offset = 4
+
+    while offset < len(snapshot):
+        guild_id, length = struct.unpack_from("<qI", snapshot, offset)
+        offset += struct.calcsize("<qI")
+        store.guild(guild_id)["score"].history.restore(snapshot[offset:offset + length])
+        offset += length
+
+def save_history(snapshot):
+
+    """Save the score history"""
+
+    with open(HISTORY_PATH + '.tmp', 'wb') as history:
+        history.write(snapshot)
+
+    os.replace(HISTORY_PATH + '.tmp', HISTORY_PATH)
+
+def close_storage():
+
+    """Save the score history, notice deletions and pending changes (shutdown)"""
+
+    if not store.closed:
+        store.writer.submit(save_history, history_snapshot())
+        notices.save()
+        store.close()
+
+if os.path.exists(HISTORY_PATH):
+    with open(HISTORY_PATH, 'rb') as history_file:
+        restore_history(history_file.read())
+
+# -------------------------------------------------------------------------------------------------
+# Extract configuration values
+# -------------------------------------------------------------------------------------------------
+
+TOKEN = config["bot"]["token"]
+PREFIX = config["bot"]["prefix"]
+
+# -------------------------------------------------------------------------------------------------
+# REST scheduler
+# -------------------------------------------------------------------------------------------------
+
+REST_PRIORITIES = {
+    "moderation": 0, "verification": 1, "roles": 2, "logs": 3, "fun": 4, "cleanup": 5
+}
+
+class RouteBucket:
+
+    """Rate limit of an API route, learned from the headers of its responses"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.inflight = 0
+        self.queue = []
+
+    def update(self, headers, now):
+
+        """Read the rate limit headers of a response"""
+
+        remaining = headers.get("X-RateLimit-Remaining")
+
+        if remaining is None:
+            return
+
+        self.remaining = int(remaining)
+        self.limit = int(headers.get("X-RateLimit-Limit", self.remaining + 1))
+        self.reset_at = now + float(headers.get("X-RateLimit-Reset-After", 0))
+
+    def ready_at(self, now):
+
+        """When the next call may start (None until a running call ends)"""
+
+        if self.remaining is None:
+            return None if self.inflight else now
+
+        if now >= self.reset_at:
+            self.remaining = self.limit
+        if self.remaining > self.inflight:
+            return now
+
+        return self.reset_at if self.reset_at > now else None
+
+class RestOperation:
+
+    """Queued REST call"""
+
+    def __init__(self, priority, route, call, key):
+        self.priority = priority
+        self.rank = REST_PRIORITIES[priority]
+        self.route = route
+        self.call = call
+        self.key = key
+        self.queued = time.perf_counter()
+        self.started = False
+        self.future = asyncio.get_running_loop().create_future()
+
+class RestScheduler:
+
+    """Outbound REST calls, started by priority within the rate limit of their route"""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.buckets = {}
+        self.waiting = set()
+        self.pending = {}
+        self.paths = {}
+        self.running = 0
+        self.sequence = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_end.append(self.on_request_end)
+
+    def submit(self, priority, route, call, key=None):
+
+        """Queue a call and return the future of its result
+
+        Calls sharing a key are coalesced while queued: the latest call runs once,
+        with the highest of their priorities, and every caller gets its result.
+        """
+
+        rank = REST_PRIORITIES[priority]
+        operation = self.pending.get(key) if key is not None else None
+
+        if operation is not None:
+            operation.call = call
+            if rank >= operation.rank:
+                return operation.future
+            operation.priority = priority
+            operation.rank = rank
+        else:
+            operation = RestOperation(priority, route, call, key)
+            if key is not None:
+                self.pending[key] = operation
+
+        bucket_key = f"{route.key}:{route.major_parameters}"
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self.buckets[bucket_key] = RouteBucket()
+
+        self.sequence += 1
+        heapq.heappush(bucket.queue, (rank, self.sequence, operation))
+        self.waiting.add(bucket)
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.dispatch())
+        self.wakeup.set()
+
+        return operation.future
+
+    async def dispatch(self):
+
+        """Start calls as their routes and the concurrency allow"""
+
+        while True:
+            self.wakeup.clear()
+            delay = self.start_ready()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_ready(self):
+
+        """Start every call that may run now, and return the delay until a route reopens"""
+
+        while True:
+            now = time.monotonic()
+            best = None
+            delay = None
+
+            for bucket in tuple(self.waiting):
+                queue = bucket.queue
+                while queue and (queue[0][2].started or queue[0][0] != queue[0][2].rank):
+                    heapq.heappop(queue)
+
+                if not queue:
+                    self.waiting.discard(bucket)
+                    continue
+
+                ready_at = bucket.ready_at(now)
+                if ready_at is None:
+                    continue
+                if ready_at > now:
+                    delay = ready_at - now if delay is None else min(delay, ready_at - now)
+                    continue
+
+                if best is None or queue[0] < best.queue[0]:
+                    best = bucket
+
+            if best is None:
+                return delay
+
+            # Moderation never waits for a free slot
+            moderation = best.queue[0][0] == REST_PRIORITIES["moderation"]
+            if self.running >= self.concurrency and not moderation:
+                return delay
+
+            operation = heapq.heappop(best.queue)[2]
+            operation.started = True
+            if operation.key is not None and self.pending.get(operation.key) is operation:
+                del self.pending[operation.key]
+
+            self.running += 1
+            best.inflight += 1
+            asyncio.create_task(self.run(best, operation))
+
+    async def run(self, bucket, operation):
+
+        """Run a call and settle its future"""
+
+        route = operation.route
+        path = (route.method, URL(route.url).path)
+
+        # Calls in flight on each path, so every response of the path is read
+        tracked = self.paths.get(path)
+        if tracked is None:
+            tracked = self.paths[path] = [bucket, 0]
+        tracked[1] += 1
+
+        metrics.record(f"rest_wait:{operation.priority}", time.perf_counter() - operation.queued)
+
+        try:
+            result = await operation.call()
+        except Exception as error:
+            if not operation.future.done():
+                operation.future.set_exception(error)
+        else:
+            if not operation.future.done():
+                operation.future.set_result(result)
+        finally:
+            self.running -= 1
+            bucket.inflight -= 1
+            tracked[1] -= 1
+            if not tracked[1]:
+                del self.paths[path]
+            self.wakeup.set()
+
+    def backlog(self):
+
+        """Queued calls by priority"""
+
+        counts = dict.fromkeys(REST_PRIORITIES, 0)
+
+        for bucket in self.waiting:
+            for rank, _, operation in bucket.queue:
+                if not operation.started and rank == operation.rank:
+                    counts[operation.priority] += 1
+
+        return counts
+
+    async def on_request_end(self, session, context, params):
+
+        """Learn the rate limit of a scheduled route from its response"""
+
+        tracked = self.paths.get((params.method, params.url.path))
+
+        if tracked is not None:
+            tracked[0].update(params.response.headers, time.monotonic())
+            self.wakeup.set()
+
+rest_config = config.get("rest", {})
+rest = RestScheduler(rest_config.get("concurrency", 8))
+
+# -------------------------------------------------------------------------------------------------
+# Initialize the bot
+# -------------------------------------------------------------------------------------------------
+
+intents = discord.Intents.all()
+bot = commands.Bot(command_prefix=(PREFIX), intents=intents, http_trace=rest.trace)
+
+# -------------------------------------------------------------------------------------------------
+# Event: Bot ready
+# -------------------------------------------------------------------------------------------------
+
+@bot.event
+async def on_ready():
+
+    """Actions on bot ready"""
+
+    print(f"Bot connected: {bot.user}")
+
+    activity_type = config['activity']['type']
+    activity_name = config['activity']['name']
+    activity_start = datetime.datetime.utcnow().isoformat()
+
+    assets = {}
+    assets['large_image'] = config['activity']['assets']['large_image']
+    assets['large_text'] = config['activity']['assets']['large_text']
+
+    activity = discord.Activity(
+        type=discord.ActivityType[activity_type],
+        name=activity_name,
+        start=activity_start,
+        assets=assets
+    )
+
+    status_str = config['status']
+
+    if status_str == 'do_not_disturb':
+        status_str = 'dnd'
+
+    status = getattr(discord.Status, status_str, discord.Status.online)
+
+    await bot.change_presence(activity=activity, status=status)
+
+    bot.loop.create_task(daily_decrease(scheduler.now()))
+    scheduler.start()
+    code_expiry.arm()
+    notices.arm()
+
+    if metrics.enabled:
+        loop_lag_probe.start()
+        await metrics_server.start()
+
+    if watchdog_config.get("enabled", False):
+        loop_watchdog.start()
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Ephemeral notices
+# -------------------------------------------------------------------------------------------------
+
+NOTICES_PATH = storage_config.get("notices_path", "notices.json")
+
+class EphemeralNotices:
+
+    """Bot messages deleted after a delay, on a single timer
+
+    A deletion waits up to `window` more seconds, so the notices of a channel that are due
+    together go out in one bulk delete. Pending deletions are saved, so a restart does not
+    leave notices behind."""
+
+    def __init__(self, delay, window):
+        self.delay = delay
+        self.window = window
+        self.heap = []
+        self.handle = None
+        self.save_handle = None
+
+    def load(self, entries):
+
+        """Rebuild the heap from the saved deletions"""
+
+        self.heap = [tuple(entry) for entry in entries]
+        heapq.heapify(self.heap)
+
+    def schedule(self, message, delay=None):
+
+        """Delete a message after a delay (the configured one by default)"""
+
+        due = time.time() + (self.delay if delay is None else delay)
+        entry = (due, message.channel.id, message.id)
+        heapq.heappush(self.heap, entry)
+
+        if self.heap[0] == entry:
+            self.arm()
+        self.save_later()
+
+    def arm(self):
+
+        """Set the timer for the earliest deletion"""
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.heap:
+            delay = max(0, self.heap[0][0] + self.window - time.time())
+            self.handle = asyncio.get_running_loop().call_later(delay, self.sweep)
+
+    def sweep(self):
+
+        """Delete the due notices, grouped by channel"""
+
+        self.handle = None
+        now = time.time()
+        channels = {}
 
-    with open('config.json', 'w', encoding='utf-8') as configuration:
-        json.dump(config, configuration, indent=4)
+        while self.heap and self.heap[0][0] <= now:
+            _, channel_id, message_id = heapq.heappop(self.heap)
+            channels.setdefault(channel_id, []).append(message_id)
 
-config = load_config()
+        for channel_id, message_ids in channels.items():
+            asyncio.create_task(self.delete(channel_id, message_ids))
 
-# -------------------------------------------------------------------------------------------------
-# Read database from data.json
-# -------------------------------------------------------------------------------------------------
+        self.arm()
+        self.save_later()
 
-def load_data():
+    async def delete(self, channel_id, message_ids):
 
-    """Load the database from data.json"""
+        """Delete notices of a channel, up to 100 per bulk delete"""
 
-    with open('data.json', 'r', encoding='utf-8') as database:
-        return json.load(database)
+        # Bulk deletes refuse messages older than two weeks
+        oldest = discord.utils.time_snowflake(
+            discord.utils.utcnow() - datetime.timedelta(days=13, hours=23)
+        )
+        recent = [message_id for message_id in message_ids if message_id > oldest]
+        single = [message_id for message_id in message_ids if message_id <= oldest]
 
-def save_data(data):
+        for start in range(0, len(recent), 100):
+            batch = recent[start:start + 100]
 
-    """Save the database to data.json"""
+            if len(batch) == 1:
+                single.extend(batch)
+                continue
 
-    with open('data.json', 'w', encoding='utf-8') as database:
-        json.dump(data, database, indent=4)
+            # Bulk deletes need Manage Messages, deleting its own messages one by one does not
+            try:
+                await rest.submit(
+                    "cleanup",
+                    Route(
+                        'POST', '/channels/{channel_id}/messages/bulk-delete',
+                        channel_id=channel_id
+                    ),
+                    functools.partial(bot.http.delete_messages, channel_id, batch)
+                )
+            except discord.HTTPException:
+                single.extend(batch)
+            else:
+                metrics.count("notices_deleted", len(batch))
 
-data = load_data()
+        for message_id in single:
+            try:
+                await rest.submit(
+                    "cleanup",
+                    Route(
+                        'DELETE', '/channels/{channel_id}/messages/{message_id}',
+                        channel_id=channel_id, message_id=message_id
+                    ),
+                    functools.partial(bot.http.delete_message, channel_id, message_id)
+                )
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as error:
+                print(f"An error occurred while deleting a notice: {error}")
+            else:
+                metrics.count("notices_deleted")
 
-# -------------------------------------------------------------------------------------------------
-# Extract configuration values
-# -------------------------------------------------------------------------------------------------
+    def save_later(self):
 
-TOKEN = config["bot"]["token"]
-PREFIX = config["bot"]["prefix"]
+        """Save the pending deletions within a second"""
 
-# -------------------------------------------------------------------------------------------------
-# Initialize the bot
-# -------------------------------------------------------------------------------------------------
+        if self.save_handle is None and not store.closed:
+            self.save_handle = asyncio.get_running_loop().call_later(1, self.save)
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix=(PREFIX), intents=intents)
+    def save(self):
 
-# -------------------------------------------------------------------------------------------------
-# Event: Bot ready
-# -------------------------------------------------------------------------------------------------
+        """Save the pending deletions in the writer thread"""
 
-@bot.event
-async def on_ready():
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
 
-    """Actions on bot ready"""
+        store.writer.submit(save_notices, json.dumps(self.heap))
 
-    print(f"Bot connected: {bot.user}")
+def save_notices(snapshot):
 
-    activity_type = config['activity']['type']
-    activity_name = config['activity']['name']
-    activity_start = datetime.datetime.utcnow().isoformat()
+    """Save the pending notice deletions"""
 
-    assets = {}
-    assets['large_image'] = config['activity']['assets']['large_image']
-    assets['large_text'] = config['activity']['assets']['large_text']
+    with open(NOTICES_PATH + '.tmp', 'w', encoding='utf-8') as pending:
+        pending.write(snapshot)
 
-    activity = discord.Activity(
-        type=discord.ActivityType[activity_type],
-        name=activity_name,
-        start=activity_start,
-        assets=assets
-    )
+    os.replace(NOTICES_PATH + '.tmp', NOTICES_PATH)
 
-    status_str = config['status']
+notices_config = config.get("notices", {})
+notices = EphemeralNotices(notices_config.get("delay", 5), notices_config.get("window", 1))
 
-    if status_str == 'do_not_disturb':
-        status_str = 'dnd'
+if os.path.exists(NOTICES_PATH):
+    with open(NOTICES_PATH, 'r', encoding='utf-8') as notices_file:
+        notices.load(json.load(notices_file))
 
-    status = getattr(discord.Status, status_str, discord.Status.online)
+async def send_notice(ctx, content, delay=None):
 
-    await bot.change_presence(activity=activity, status=status)
+    """Send a message deleted after a few seconds, without waiting for it"""
 
-    bot.loop.create_task(daily_decrease())
+    message = await ctx.send(content)
+    notices.schedule(message, delay)
+    return message
 
 # -------------------------------------------------------------------------------------------------
 # Handler: Errors
@@ -132,101 +1999,443 @@ async def on_command_error(ctx, error):
 
     if isinstance(error, commands.MissingRequiredArgument):
         await ctx.message.delete()
-        timeout_message = await ctx.send("Missing required arguments.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Missing required arguments.")
         return
 
     if isinstance(error, commands.BadArgument):
         await ctx.message.delete()
-        timeout_message = await ctx.send("One or more arguments are invalid.")
+        await send_notice(ctx, "One or more arguments are invalid.")
         return
 
     if isinstance(error, commands.CommandInvokeError):
         await ctx.message.delete()
-        timeout_message = await ctx.send("Command aborted.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Command aborted.")
         return
 
     await ctx.message.delete()
     error_message = f"Error: {error}"
-    timeout_message = await ctx.send(error_message)
-    await asyncio.sleep(5)
-    await timeout_message.delete()
+    await send_notice(ctx, error_message)
     return
 
 # -------------------------------------------------------------------------------------------------
-# Handler: Role update
+# Handler: Role mutation queue
 # -------------------------------------------------------------------------------------------------
 
-async def role_update():
+class RoleQueue:
 
-    """Actions on role update"""
+    """Pending role changes, applied with one member edit per member
 
-    server = bot.get_guild(config["bot"]["server"])
-    active_role = server.get_role(config["score"]["active_role"])
-    passive_role = server.get_role(config["score"]["passive_role"])
+    Each server has its own queue and workers, so a server waiting on its rate limit does not
+    hold up the role changes of the others."""
 
-    for user_score in data["score"]:
-        user = server.get_member(user_score["user"])
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.pending = {}
+        self.priorities = {}
+        self.active = set()
+        self.sequence = 0
+        self.queues = {}
+        self.workers = {}
 
-        if user:
-            user_score["points"] = min(
-                user_score["points"], config["score"]["limit"]
+    def submit(self, member, add=(), remove=(), priority="roles"):
+
+        """Queue roles to add to and remove from a member"""
+
+        key = (member.guild.id, member.id)
+        rank = REST_PRIORITIES[priority]
+        queued = self.priorities.get(key)
+
+        if queued is None or rank < REST_PRIORITIES[queued]:
+            self.priorities[key] = priority
+            if key not in self.active:
+                self.sequence += 1
+                self.queue(member.guild.id).put_nowait((rank, self.sequence, key))
+
+        changes = self.pending.setdefault(key, {})
+
+        for role in add:
+            if role:
+                changes[role.id] = True
+        for role in remove:
+            if role:
+                changes[role.id] = False
+
+    def queue(self, guild_id):
+
+        """Queue of a server, with its workers started on first use"""
+
+        queue = self.queues.get(guild_id)
+
+        if queue is None:
+            queue = self.queues[guild_id] = asyncio.PriorityQueue()
+            self.workers[guild_id] = [
+                asyncio.create_task(self.worker(queue)) for _ in range(self.concurrency)
+            ]
+
+        return queue
+
+    async def worker(self, queue):
+
+        """Apply queued role changes of a server"""
+
+        while True:
+            _, _, key = await queue.get()
+
+            # Left over after the member was raised to a higher priority
+            if key in self.active or key not in self.pending:
+                continue
+
+            self.active.add(key)
+
+            try:
+                await self.apply(key)
+            except Exception as error:
+                print(f"An error occurred while updating roles: {error}")
+            finally:
+                self.active.discard(key)
+                self.pending.pop(key, None)
+                self.priorities.pop(key, None)
+
+    async def apply(self, key):
+
+        """Edit the roles of a member until no change is left for them"""
+
+        guild_id, member_id = key
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild else None
+
+        if member is None:
+            return
+
+        current = {role.id for role in member.roles if not role.is_default()}
+
+        while key in self.pending:
+            changes = self.pending.pop(key)
+
+            wanted = set(current)
+            for role_id, granted in changes.items():
+                if granted:
+                    wanted.add(role_id)
+                else:
+                    wanted.discard(role_id)
+
+            if wanted == current:
+                continue
+
+            roles = [discord.Object(id=role_id) for role_id in wanted]
+            priority = self.priorities.get(key, "roles")
+            route = Route(
+                'PATCH', '/guilds/{guild_id}/members/{user_id}',
+                guild_id=guild_id, user_id=member_id
             )
 
-            if user_score["points"] >= config["score"]["threshold"]:
+            await rest.submit(priority, route, functools.partial(member.edit, roles=roles))
+            metrics.count("role_edits")
+            current = wanted
+
+role_queue_config = config.get("role_queue", {})
+role_queue = RoleQueue(role_queue_config.get("concurrency", 4))
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Role update
+# -------------------------------------------------------------------------------------------------
+
+@metrics.timed("role_update")
+def role_update(guild_id, user_ids=None):
+
+    """Actions on role update (every scored member of the server if no user is given)"""
+
+    server = bot.get_guild(guild_id)
+
+    if server is None:
+        return
+
+    settings = guild_config(guild_id, "score")
+    active_role = server.get_role(settings["active_role"])
+    passive_role = server.get_role(settings["passive_role"])
+    scores = store.guild(guild_id)["score"]
+
+    if user_ids is None:
+        user_ids = tuple(scores)
+
+    for user_id in user_ids:
+        user = server.get_member(user_id)
+        points = scores.get(user_id)
+
+        if user:
+            if points >= scores.threshold:
                 if active_role not in user.roles:
-                    await user.add_roles(active_role)
-                    await user.remove_roles(passive_role)
+                    role_queue.submit(user, add=(active_role,), remove=(passive_role,))
             else:
                 if passive_role not in user.roles:
-                    await user.remove_roles(active_role)
-                    await user.add_roles(passive_role)
+                    role_queue.submit(user, add=(passive_role,), remove=(active_role,))
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Message rewards
+# -------------------------------------------------------------------------------------------------
+
+class ScoreIngest:
+
+    """Message rewards of a server, applied in batches outside of the message handler"""
+
+    def __init__(self, guild_id, batch_size, reward_window):
+        self.guild_id = guild_id
+        self.batch_size = batch_size
+        self.reward_window = reward_window
+        self.rewarded = {}
+        self.prune_size = 1024
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def push(self, user_id, timestamp):
+
+        """Queue the reward for a message, unless its author was rewarded too recently"""
+
+        metrics.count("messages_ingested")
+
+        if self.reward_window:
+            last = self.rewarded.get(user_id)
+            if last is not None and timestamp - last < self.reward_window:
+                return
+
+            self.rewarded[user_id] = timestamp
+
+            if len(self.rewarded) > self.prune_size:
+                self.rewarded = {
+                    user: rewarded for user, rewarded in self.rewarded.items()
+                    if timestamp - rewarded < self.reward_window
+                }
+                self.prune_size = max(1024, 2 * len(self.rewarded))
+
+        self.queue.put_nowait((user_id, timestamp))
+        metrics.count("messages_queued")
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.consume())
+
+    async def consume(self):
+
+        """Apply queued rewards as they come, one batch at a time"""
+
+        while True:
+            batch = [await self.queue.get()]
+
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                self.apply(batch)
+            except Exception as error:
+                print(f"An error occurred while rewarding messages: {error}")
+
+            await asyncio.sleep(0)
+
+    def apply(self, batch):
+
+        """Reward a batch of messages, then update roles once
+
+        Every rewarded member gets their role checked, not only those who crossed the threshold,
+        so a score role removed by hand or changed in config is fixed on their next message."""
+
+        messages = {}
+        for user_id, _ in batch:
+            messages[user_id] = messages.get(user_id, 0) + 1
+
+        settings = guild_config(self.guild_id, "score")
+        scores = store.guild(self.guild_id)["score"]
+
+        for user_id, count in messages.items():
+            scores.add(user_id, settings["reward"] * count, settings["limit"])
+            store.mark_dirty(self.guild_id, "score", user_id)
+
+        role_update(self.guild_id, messages)
+
+score_ingests = {}
+
+def score_ingest(guild_id):
+
+    """Message reward queue of a server (each server is consumed by its own task)"""
+
+    ingest = score_ingests.get(guild_id)
+
+    if ingest is None:
+        settings = guild_config(guild_id, "score")
+        ingest = score_ingests[guild_id] = ScoreIngest(
+            guild_id,
+            settings.get("batch_size", 256),
+            settings.get("reward_window", 0)
+        )
+
+    return ingest
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Scheduled jobs
+# -------------------------------------------------------------------------------------------------
+
+class ScheduledJob:
+
+    """Callback run at calendar times"""
+
+    def __init__(self, name, callback, next_run, due):
+        self.name = name
+        self.callback = callback
+        self.next_run = next_run
+        self.due = due
+        self.handle = None
+        self.task = None
+
+class JobScheduler:
+
+    """Jobs run at calendar times in a timezone, each on its own loop timer
+
+    Nothing runs between jobs. Timers wake up at least once an hour to check the clock, so
+    a clock change or a suspended host does not delay a job by more than that."""
+
+    def __init__(self, timezone):
+        self.timezone = timezone
+        self.jobs = {}
+        self.running = False
+
+    def now(self):
+
+        """Current time in the timezone of the scheduler"""
+
+        return datetime.datetime.now(self.timezone)
+
+    def daily(self, name, callback, at=datetime.time()):
+
+        """Run a job every day at a time of day (midnight by default)"""
+
+        def next_run(after):
+            run = datetime.datetime.combine(after.date(), at, tzinfo=self.timezone)
+            if run <= after:
+                run = datetime.datetime.combine(
+                    after.date() + datetime.timedelta(days=1), at, tzinfo=self.timezone
+                )
+            return run
+
+        self.add(name, callback, next_run)
+
+    def every(self, name, callback, seconds):
+
+        """Run a job at a fixed interval"""
+
+        self.add(name, callback, lambda after: after + datetime.timedelta(seconds=seconds))
+
+    def add(self, name, callback, next_run):
+
+        """Register a job, called with the current time when it is due"""
+
+        job = self.jobs[name] = ScheduledJob(name, callback, next_run, next_run(self.now()))
+
+        if self.running:
+            self.arm(job)
+
+    def start(self):
+
+        """Set the timers of every job"""
+
+        if self.running:
+            return
+
+        self.running = True
+
+        for job in self.jobs.values():
+            self.arm(job)
+
+    def arm(self, job):
+
+        """Set the timer of a job for its next run"""
+
+        delay = min(max(0, job.due.timestamp() - time.time()), 3600)
+        job.handle = asyncio.get_running_loop().call_later(delay, self.fire, job)
+
+    def fire(self, job):
+
+        """Run a job if it is due, then set its timer again"""
+
+        if time.time() >= job.due.timestamp():
+            now = self.now()
+            job.due = job.next_run(now)
+            job.task = asyncio.create_task(self.run(job, now))
+
+        self.arm(job)
+
+    async def run(self, job, now):
+
+        """Run a job and report its errors"""
+
+        try:
+            result = job.callback(now)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as error:
+            print(f"An error occurred in scheduled job {job.name}: {error}")
+
+scheduler_config = config.get("scheduler", {})
+scheduler = JobScheduler(
+    None if scheduler_config.get("timezone", "local") == "local"
+    else zoneinfo.ZoneInfo(scheduler_config["timezone"])
+)
 
 # -------------------------------------------------------------------------------------------------
 # Handler: Daily score decrease
 # -------------------------------------------------------------------------------------------------
 
-async def daily_decrease():
+def guild_decrease(guild_id, now):
+
+    """Daily score decrease of a server"""
 
-    """Daily score decrease"""
+    guild = store.guild(guild_id)
+    today = now.date().toordinal()
 
-    await bot.wait_until_ready()
-    while not bot.is_closed():
+    if guild["score"].lazy:
+        moved = guild["score"].advance(today)
+    else:
+        moved = guild["score"].decay(today)
+        store.mark_dirty(guild_id, "score")
 
-        now = datetime.datetime.now()
+    guild["last_daily"] = now.date().strftime('%Y-%m-%d')
+    store.mark_dirty(guild_id, "last_daily", "last_daily")
 
-        print(f"Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}")
+    role_update(guild_id, moved)
 
-        last_daily_value = data.get("last_daily", None)
+async def daily_decrease(now):
 
-        if last_daily_value != now.date().strftime('%Y-%m-%d'):
-            print("Starting daily task...")
+    """Daily score decrease of every server not decreased today yet
 
-            limit = config["score"]["limit"]
+    Every day since the last decrease is applied at once, so this also catches up after the
+    bot was offline."""
 
-            for user_score in data["score"]:
-                if "user" in user_score and "points" in user_score:
-                    points = user_score["points"]
-                    if points >= limit:
-                        continue
-                    new_points = max(0, points - config["score"]["daily"])
-                    user_score["points"] = new_points
+    decreased = False
 
-            data["last_daily"] = now.date().strftime('%Y-%m-%d')
-            save_data(data)
+    for guild_id in tuple(store.guilds):
+        if store.guild(guild_id).get("last_daily") != now.date().strftime('%Y-%m-%d'):
+            print(f"Starting daily task for server {guild_id}...")
+            guild_decrease(guild_id, now)
+            decreased = True
+            await asyncio.sleep(0)
 
-        await role_update()
+    if decreased:
+        store.writer.submit(save_history, history_snapshot())
         print("Daily decrease completed.")
 
-        await asyncio.sleep(21600)
+scheduler.daily("daily_decrease", daily_decrease)
 
 # -------------------------------------------------------------------------------------------------
 # Event: Membership
 # -------------------------------------------------------------------------------------------------
 
+async def post_joinlog(channel, content):
+
+    """Post to the joinlogs channel behind moderation and role changes"""
+
+    await rest.submit(
+        "logs",
+        Route('POST', '/channels/{channel_id}/messages', channel_id=channel.id),
+        functools.partial(channel.send, content)
+    )
+
 # Member Joined -----------------------------------------------------------------------------------
 
 @bot.event
@@ -234,20 +2443,21 @@ async def on_member_join(member):
 
     """Actions on member join"""
 
-    autoroles = data.get('roles', {}).get('autoroles', [])
+    guild = store.guild(member.guild.id)
+    autoroles = guild['roles']['autoroles']
 
-    for role_id in autoroles:
-        role = member.guild.get_role(role_id)
-        if role:
-            await member.add_roles(role)
+    role_queue.submit(member, add=[member.guild.get_role(role_id) for role_id in autoroles])
 
+    # A member coming back gets the score role of their kept score (in the same edit)
+    if member.id in guild['score']:
+        role_update(member.guild.id, (member.id,))
 
-    joinlogs_channel_id = config['channels']['joinlogs']
+    joinlogs_channel_id = guild_config(member.guild.id, 'channels')['joinlogs']
     joinlogs_channel = bot.get_channel(joinlogs_channel_id)
 
     if joinlogs_channel:
         join_message = f"{member.mention} ({member.display_name}, @{member.id}) joined."
-        await joinlogs_channel.send(join_message)
+        await post_joinlog(joinlogs_channel, join_message)
 
 # Member Remove -----------------------------------------------------------------------------------
 
@@ -256,7 +2466,7 @@ async def on_member_remove(member):
 
     """Actions on member remove"""
 
-    joinlogs_channel_id = config['channels']['joinlogs']
+    joinlogs_channel_id = guild_config(member.guild.id, 'channels')['joinlogs']
     joinlogs_channel = bot.get_channel(joinlogs_channel_id)
 
     if joinlogs_channel:
@@ -272,7 +2482,7 @@ async def on_member_remove(member):
         if not remove_message:
             remove_message = f"{member.mention} ({member.display_name}, @{member.id}) left."
 
-        await joinlogs_channel.send(remove_message)
+        await post_joinlog(joinlogs_channel, remove_message)
 
 # Member Unbanned ---------------------------------------------------------------------------------
 
@@ -281,12 +2491,12 @@ async def on_member_unban(guild, user):
 
     """Actions on member unbanned"""
 
-    joinlogs_channel_id = config['channels']['joinlogs']
+    joinlogs_channel_id = guild_config(guild.id, 'channels')['joinlogs']
     joinlogs_channel = bot.get_channel(joinlogs_channel_id)
 
     if joinlogs_channel:
         unban_message = f"{user.mention} unbanned."
-        await joinlogs_channel.send(unban_message)
+        await post_joinlog(joinlogs_channel, unban_message)
 
 # -------------------------------------------------------------------------------------------------
 # Event: Message
@@ -299,21 +2509,8 @@ async def on_message(message):
 
     """Actions on new messages"""
 
-    user_entry = next(
-        (entry for entry in data["score"] if entry["user"] == message.author.id),
-        None
-    )
-
-    if user_entry is None:
-        data["score"].append({"user": message.author.id, "points": config["score"]["reward"]})
-    else:
-        user_entry["points"] += config["score"]["reward"]
-        if user_entry["points"] > config["score"]["limit"]:
-            user_entry["points"] = config["score"]["limit"]
-
-    save_data(data)
-
-    await role_update()
+    if message.guild is not None:
+        score_ingest(message.guild.id).push(message.author.id, message.created_at.timestamp())
 
     if message.author == bot.user:
         return
@@ -328,19 +2525,15 @@ async def on_raw_message_delete(payload):
 
     """Actions on individual message deletion"""
 
-    message_id = payload.message_id
-    reactmessages = data['roles']['reactmessages']
-
-    index_to_remove = None
+    if payload.guild_id is None:
+        return
 
-    for index, reactmessage in enumerate(reactmessages):
-        if reactmessage['messageID'] == message_id:
-            index_to_remove = index
-            break
+    message_id = payload.message_id
+    reactroles = store.guild(payload.guild_id)['reactroles']
 
-    if index_to_remove is not None:
-        reactmessages.pop(index_to_remove)
-        save_data(data)
+    if reactroles.remove_messages({message_id}):
+        store.mark_dirty(payload.guild_id, "reactmessages", message_id)
+        reaction_states.discard((message_id,))
 
 # Purged messages  --------------------------------------------------------------------------------
 
@@ -349,24 +2542,189 @@ async def on_raw_bulk_message_delete(payload):
 
     """Actions on masse messages deletion"""
 
+    if payload.guild_id is None:
+        return
+
     deleted_message_ids = payload.message_ids
-    reactmessages = data['roles']['reactmessages']
+    reactroles = store.guild(payload.guild_id)['reactroles']
 
-    messages_to_remove = []
+    removed = reactroles.remove_messages(deleted_message_ids)
 
-    for message_id in deleted_message_ids:
-        for reactmessage in reactmessages:
-            if message_id == reactmessage['messageID']:
-                messages_to_remove.append(reactmessage)
+    if not removed:
+        return
+
+    for message_id in removed:
+        store.mark_dirty(payload.guild_id, "reactmessages", message_id)
+
+    reaction_states.discard(removed)
+
+# -------------------------------------------------------------------------------------------------
+# Event: Reaction
+# -------------------------------------------------------------------------------------------------
+
+# Reaction state ----------------------------------------------------------------------------------
+
+class ReactionStateCache:
+
+    """Emojis on recent reactrole messages, so that reactions do not need the message
+
+    A message missing from the cache is fetched once. Emojis added afterwards are added to its
+    set, and removed ones are never taken out: a raw removal does not tell whether others still
+    react with that emoji, and the bot's own reactions keep every linked emoji on the message
+    anyway. A stale emoji only costs one extra role check. The least recently used messages are
+    dropped first."""
+
+    def __init__(self, size):
+        self.size = size
+        self.emojis = OrderedDict()
+
+    def get(self, message_id):
+
+        """Emojis on a message, or None if it is not cached"""
+
+        emojis = self.emojis.get(message_id)
+        if emojis is not None:
+            self.emojis.move_to_end(message_id)
+        return emojis
+
+    def set(self, message_id, emojis):
+
+        """Cache the emojis on a message"""
+
+        emojis = self.emojis[message_id] = set(emojis)
+        self.emojis.move_to_end(message_id)
+
+        if len(self.emojis) > self.size:
+            self.emojis.popitem(last=False)
+
+        return emojis
+
+    def discard(self, message_ids):
+
+        """Forget deleted messages"""
+
+        for message_id in message_ids:
+            self.emojis.pop(message_id, None)
+
+reaction_states = ReactionStateCache(1024)
+
+# Reaction debounce -------------------------------------------------------------------------------
+
+class PendingReactions:
+
+    """Role changes and reactions to strip of a member, waiting for the debounce window"""
+
+    def __init__(self, member):
+        self.member = member
+        self.roles = {}
+        self.strips = {}
+
+class ReactionDebouncer:
+
+    """Reaction role changes of each member, folded over a short window into one role edit
+
+    Only the final state of each role is kept, so a member clicking through several emojis
+    gets a single edit. Reactions refused on mono messages are stripped once the window ends,
+    unless the member removed them first."""
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
 
-    for reactmessage in messages_to_remove:
-        data['roles']['reactmessages'].remove(reactmessage)
+    def entry(self, member):
 
-    save_data(data)
+        """Pending changes of a member, opening a window if there is none"""
+
+        key = (member.guild.id, member.id)
+        pending = self.pending.get(key)
+
+        if pending is None:
+            pending = self.pending[key] = PendingReactions(member)
+            asyncio.get_running_loop().call_later(self.window, self.flush, key)
+
+        return pending
+
+    def holds(self, member, role_id):
+
+        """Check if a member has a role once their pending changes are applied"""
+
+        pending = self.pending.get((member.guild.id, member.id))
+
+        if pending is not None and role_id in pending.roles:
+            return pending.roles[role_id]
+
+        return member.get_role(role_id) is not None
+
+    def grant(self, member, role_id):
+
+        """Give a role to a member at the end of the window"""
+
+        self.entry(member).roles[role_id] = True
+
+    def revoke(self, member, role_id):
+
+        """Take a role from a member at the end of the window"""
+
+        self.entry(member).roles[role_id] = False
+
+    def strip(self, member, message, emoji):
+
+        """Remove the reaction of a member at the end of the window"""
+
+        self.entry(member).strips[(message.id, str(emoji))] = (message, emoji)
+
+    def unstrip(self, member, message_id, emoji):
+
+        """Forget a reaction to strip that the member removed, and tell if there was one"""
+
+        pending = self.pending.get((member.guild.id, member.id))
+
+        if pending is None:
+            return False
+
+        return pending.strips.pop((message_id, str(emoji)), None) is not None
+
+    def flush(self, key):
+
+        """Queue the final role changes of a member and strip refused reactions"""
+
+        pending = self.pending.pop(key)
+        member = pending.member
+        guild = member.guild
+
+        role_queue.submit(
+            member,
+            add=[guild.get_role(role_id) for role_id, granted in pending.roles.items() if granted],
+            remove=[
+                guild.get_role(role_id) for role_id, granted in pending.roles.items() if not granted
+            ]
+        )
+
+        if pending.strips:
+            asyncio.create_task(self.strip_reactions(member, pending.strips.values()))
+
+    async def strip_reactions(self, member, strips):
+
+        """Remove refused reactions of a member"""
+
+        for message, emoji in strips:
+            try:
+                await rest.submit(
+                    "roles",
+                    Route(
+                        'DELETE',
+                        '/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/'
+                        '{member_id}',
+                        channel_id=message.channel.id, message_id=message.id,
+                        emoji=convert_emoji_reaction(emoji), member_id=member.id
+                    ),
+                    functools.partial(message.remove_reaction, emoji, member),
+                    key=("strip", message.id, str(emoji), member.id)
+                )
+            except discord.HTTPException as error:
+                print(f"An error occurred while removing a reaction: {error}")
 
-# -------------------------------------------------------------------------------------------------
-# Event: Reaction
-# -------------------------------------------------------------------------------------------------
+reaction_debouncer = ReactionDebouncer(role_queue_config.get("debounce", 1.0))
 
 # Raw reaction add --------------------------------------------------------------------------------
 
@@ -375,34 +2733,40 @@ async def on_raw_reaction_add(payload):
 
     """Actions on reaction added"""
 
-    if payload.user_id == bot.user.id:
+    if payload.user_id == bot.user.id or payload.guild_id is None:
+        return
+
+    reactroles = store.guild(payload.guild_id)['reactroles']
+    message_type = reactroles.message_types.get(payload.message_id)
+
+    if message_type is None:
         return
 
     guild = bot.get_guild(payload.guild_id)
-    channel = bot.get_channel(payload.channel_id)
-    member = guild.get_member(payload.user_id)
-    message = await channel.fetch_message(payload.message_id)
-
-    for reactmessage in data['roles']['reactmessages']:
-        if reactmessage['messageID'] == payload.message_id and reactmessage['type'] == "mono":
-            for reaction in message.reactions:
-                for reactlink in data['roles']['reactlinks']:
-                    if reactlink['reactemoji'] == str(reaction.emoji):
-                        if guild.get_role(reactlink['reactrole']) in member.roles:
-                            role_id = reactlink['reactrole']
-                            role = guild.get_role(role_id)
-                            if role:
-                                await message.remove_reaction(payload.emoji, member)
-                                return
-
-    for reactmessage in data['roles']['reactmessages']:
-        if reactmessage['messageID'] == payload.message_id:
-            for reactlink in data['roles']['reactlinks']:
-                if reactlink['reactemoji'] == str(payload.emoji):
-                    role_id = reactlink['reactrole']
-                    role = guild.get_role(role_id)
-                    if role:
-                        await member.add_roles(role)
+    member = payload.member or guild.get_member(payload.user_id)
+
+    if message_type == "mono":
+        message = bot.get_partial_messageable(payload.channel_id).get_partial_message(
+            payload.message_id
+        )
+
+        emojis = reaction_states.get(payload.message_id)
+        if emojis is None:
+            fetched = await message.fetch()
+            emojis = reaction_states.set(
+                payload.message_id, [str(reaction.emoji) for reaction in fetched.reactions]
+            )
+        emojis.add(str(payload.emoji))
+
+        for emoji in emojis:
+            role_id = reactroles.role_ids.get(emoji)
+            if role_id is not None and reaction_debouncer.holds(member, role_id):
+                reaction_debouncer.strip(member, message, payload.emoji)
+                return
+
+    role_id = reactroles.role_ids.get(str(payload.emoji))
+    if role_id is not None and guild.get_role(role_id):
+        reaction_debouncer.grant(member, role_id)
 
 # Raw reaction remove -----------------------------------------------------------------------------
 
@@ -411,22 +2775,23 @@ async def on_raw_reaction_remove(payload):
 
     """Actions on reaction deleted"""
 
-    if payload.user_id == bot.user.id:
+    if payload.user_id == bot.user.id or payload.guild_id is None:
+        return
+
+    reactroles = store.guild(payload.guild_id)['reactroles']
+
+    if payload.message_id not in reactroles.message_types:
         return
 
     guild = bot.get_guild(payload.guild_id)
-    channel = bot.get_channel(payload.channel_id)
     member = guild.get_member(payload.user_id)
-    message = await channel.fetch_message(payload.message_id)
 
-    for reactmessage in data['roles']['reactmessages']:
-        if reactmessage['messageID'] == payload.message_id:
-            for reactlink in data['roles']['reactlinks']:
-                if reactlink['reactemoji'] == str(payload.emoji):
-                    role_id = reactlink['reactrole']
-                    role = guild.get_role(role_id)
-                    if role:
-                        await member.remove_roles(role)
+    if member is None or reaction_debouncer.unstrip(member, payload.message_id, payload.emoji):
+        return
+
+    role_id = reactroles.role_ids.get(str(payload.emoji))
+    if role_id is not None and guild.get_role(role_id):
+        reaction_debouncer.revoke(member, role_id)
 
 # -------------------------------------------------------------------------------------------------
 # Command: Help
@@ -444,7 +2809,7 @@ class CustomHelpCommand(commands.MinimalHelpCommand):
             "help",
             "invite",
             "say", "edit", "clear",
-            "timeout", "kick", "ban", "unban",
+            "timeout", "kick", "ban", "unban", "stats", "stalls",
             "autorole", "reactrole", "score", "verify", "code",
             "avatar", "duel", "love", "rate"
         ]
@@ -520,7 +2885,7 @@ class CustomHelpCommand(commands.MinimalHelpCommand):
         subcommand_order = {
             "autorole": ["add", "remove", "list", "clear"],
             "reactrole": ["link", "unlink", "list", "clear", "mono", "multi"],
-            "score": ["view", "set"]
+            "score": ["view", "top", "rank", "history", "set"]
         }
 
         desired_order = subcommand_order.get(group.qualified_name, [])
@@ -562,7 +2927,7 @@ async def invite(ctx):
 
     await ctx.message.delete()
 
-    invite_channel_id = int(config['channels']['invite'])
+    invite_channel_id = int(guild_config(ctx.guild.id, 'channels')['invite'])
     invite_channel = bot.get_channel(invite_channel_id)
     invite = await invite_channel.create_invite()
 
@@ -607,9 +2972,7 @@ async def edit(ctx, message_id: int, *, new_content):
         except discord.NotFound:
             pass
 
-    timeout_message = await ctx.send("Message not found in any channel.")
-    await asyncio.sleep(5)
-    await timeout_message.delete()
+    await send_notice(ctx, "Message not found in any channel.")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Clear
@@ -624,15 +2987,11 @@ async def clear(ctx, amount: int):
     await ctx.message.delete()
 
     if amount <= 0:
-        timeout_message = await ctx.send("Please provide a valid number of messages to clear.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Please provide a valid number of messages to clear.")
         return
 
     deleted = await ctx.channel.purge(limit=amount)
-    timeout_message = await ctx.send(f"Cleared {len(deleted)} messages.")
-    await asyncio.sleep(5)
-    await timeout_message.delete()
+    await send_notice(ctx, f"Cleared {len(deleted)} messages.")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Avatar
@@ -657,9 +3016,7 @@ async def avatar(ctx, user: discord.Member=None):
         await ctx.send(avatar_url)
 
     else:
-        timeout_message = await ctx.send("This user does not have an avatar set!")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "This user does not have an avatar set!")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Timeout
@@ -687,12 +3044,11 @@ async def timeout(ctx, member: discord.Member, duration: str = '60m', *, reason:
         timeout_seconds = numeric_duration * units[unit]
     else:
         await ctx.message.delete()
-        timeout_message = await ctx.send(
+        await send_notice(
+            ctx,
             "Invalid duration unit. Use 'd' (days), 'h' (hours), "
             "'m' (minutes), or 's' (seconds)."
         )
-        await asyncio.sleep(5)
-        await timeout_message.delete()
         return
 
     combined_duration = re.findall(r'(\d+[dhms])', duration)
@@ -706,9 +3062,7 @@ async def timeout(ctx, member: discord.Member, duration: str = '60m', *, reason:
 
     if datetime.timedelta(seconds=total_seconds) > max_duration:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Duration too long!")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Duration too long!")
         return
 
     timeout = datetime.timedelta(seconds=total_seconds)
@@ -723,10 +3077,15 @@ async def timeout(ctx, member: discord.Member, duration: str = '60m', *, reason:
     duration_str = f"{days:02d}d {hours:02d}h {minutes:02d}m {seconds:02d}s"
 
     try:
-        if reason:
-            await member.timeout(timeout, reason=reason)
-        else:
-            await member.timeout(timeout)
+        await rest.submit(
+            "moderation",
+            Route(
+                'PATCH', '/guilds/{guild_id}/members/{user_id}',
+                guild_id=ctx.guild.id, user_id=member.id
+            ),
+            functools.partial(member.timeout, timeout, reason=reason),
+            key=("timeout", ctx.guild.id, member.id)
+        )
 
         if reason:
             message = (
@@ -740,16 +3099,12 @@ async def timeout(ctx, member: discord.Member, duration: str = '60m', *, reason:
 
     except discord.Forbidden:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Cannot time out {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Cannot time out {member.mention}.")
         return
 
     except discord.HTTPException:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Error trying to time out {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Error trying to time out {member.mention}.")
         return
 
 # -------------------------------------------------------------------------------------------------
@@ -763,21 +3118,25 @@ async def kick(ctx, member: discord.Member):
     """Kick a member"""
 
     try:
-        await member.kick()
+        await rest.submit(
+            "moderation",
+            Route(
+                'DELETE', '/guilds/{guild_id}/members/{user_id}',
+                guild_id=ctx.guild.id, user_id=member.id
+            ),
+            member.kick,
+            key=("kick", ctx.guild.id, member.id)
+        )
         await ctx.send(f"{member.mention} has been kicked.")
 
     except discord.Forbidden:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Cannot kick {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Cannot kick {member.mention}.")
         return
 
     except discord.HTTPException:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Error trying to kick {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Error trying to kick {member.mention}.")
         return
 
 # -------------------------------------------------------------------------------------------------
@@ -791,21 +3150,25 @@ async def ban(ctx, member: discord.Member):
     """Ban a member"""
 
     try:
-        await member.ban()
+        await rest.submit(
+            "moderation",
+            Route(
+                'PUT', '/guilds/{guild_id}/bans/{user_id}',
+                guild_id=ctx.guild.id, user_id=member.id
+            ),
+            member.ban,
+            key=("ban", ctx.guild.id, member.id)
+        )
         await ctx.send(f"{member.mention} has been banned.")
 
     except discord.Forbidden:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Cannot ban {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Cannot ban {member.mention}.")
         return
 
     except discord.HTTPException:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Error trying to ban {member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Error trying to ban {member.mention}.")
         return
 
 # -------------------------------------------------------------------------------------------------
@@ -833,36 +3196,36 @@ async def unban(ctx, member_input):
 
     if int(member_id) not in banned_users:
         await ctx.message.delete()
-        timeout_message = await ctx.send("User not banned.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "User not banned.")
         return
 
     try:
         banned_member = await bot.fetch_user(int(member_id))
     except discord.NotFound:
         await ctx.message.delete()
-        timeout_message = await ctx.send("User not found.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "User not found.")
         return
 
     try:
-        await ctx.guild.unban(banned_member)
+        await rest.submit(
+            "moderation",
+            Route(
+                'DELETE', '/guilds/{guild_id}/bans/{user_id}',
+                guild_id=ctx.guild.id, user_id=banned_member.id
+            ),
+            functools.partial(ctx.guild.unban, banned_member),
+            key=("unban", ctx.guild.id, banned_member.id)
+        )
         await ctx.send(f"{banned_member.mention} has been unbanned.")
 
     except discord.Forbidden:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Cannot unban {banned_member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Cannot unban {banned_member.mention}.")
         return
 
     except discord.HTTPException:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Error trying to unban {banned_member.mention}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Error trying to unban {banned_member.mention}.")
         return
 
 # -------------------------------------------------------------------------------------------------
@@ -877,9 +3240,7 @@ async def autorole(ctx):
 
     if ctx.invoked_subcommand is None:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Invalid subcommand.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Invalid subcommand.")
         return
 
 # Subcommand: add ---------------------------------------------------------------------------------
@@ -889,17 +3250,15 @@ async def add(ctx, *roles: discord.Role):
 
     """Add an autorole"""
 
-    autoroles = data['roles']['autoroles']
+    autoroles = store.guild(ctx.guild.id)['roles']['autoroles']
 
     for role in roles:
         if role.id in autoroles:
             await ctx.message.delete()
-            timeout_message = await ctx.send(f"Role {role.mention} is already in autoroles.")
-            await asyncio.sleep(5)
-            await timeout_message.delete()
+            await send_notice(ctx, f"Role {role.mention} is already in autoroles.")
         else:
             autoroles.append(role.id)
-            save_data(data)
+            store.mark_dirty(ctx.guild.id, "autoroles", role.id)
             await ctx.send(f"Role {role.mention} added to autoroles.")
 
 # Subcommand: remove ------------------------------------------------------------------------------
@@ -909,18 +3268,16 @@ async def remove(ctx, *roles: discord.Role):
 
     """Remove an autorole"""
 
-    autoroles = data['roles']['autoroles']
+    autoroles = store.guild(ctx.guild.id)['roles']['autoroles']
 
     for role in roles:
         if role.id in autoroles:
             autoroles.remove(role.id)
-            save_data(data)
+            store.mark_dirty(ctx.guild.id, "autoroles", role.id)
             await ctx.send(f"Role {role.mention} removed from autoroles.")
         else:
             await ctx.message.delete()
-            timeout_message = await ctx.send(f"Role {role.mention} not found in autoroles.")
-            await asyncio.sleep(5)
-            await timeout_message.delete()
+            await send_notice(ctx, f"Role {role.mention} not found in autoroles.")
 
 # Subcommand: list --------------------------------------------------------------------------------
 
@@ -929,7 +3286,7 @@ async def list(ctx):
 
     """List autoroles"""
 
-    autoroles = data['roles']['autoroles']
+    autoroles = store.guild(ctx.guild.id)['roles']['autoroles']
     autorole_list = [f'<@&{role_id}>' for role_id in autoroles]
 
     if autorole_list:
@@ -948,13 +3305,11 @@ async def clear(ctx):
 
     await ctx.message.delete()
 
-    data['roles']['autoroles'] = []
+    store.guild(ctx.guild.id)['roles']['autoroles'] = []
 
-    save_data(data)
+    store.mark_dirty(ctx.guild.id, "autoroles")
 
-    timeout_message = await ctx.send("Autoroles cleared.")
-    await asyncio.sleep(5)
-    await timeout_message.delete()
+    await send_notice(ctx, "Autoroles cleared.")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Reactrole
@@ -968,9 +3323,7 @@ async def reactrole(ctx):
 
     if ctx.invoked_subcommand is None:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Invalid subcommand.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Invalid subcommand.")
         return
 
 # Subcommand: link --------------------------------------------------------------------------------
@@ -980,22 +3333,16 @@ async def link(ctx, role: discord.Role, emoji: str):
 
     """Link a role to an emoji"""
 
-    reactlinks = data['roles']['reactlinks']
+    reactroles = store.guild(ctx.guild.id)['reactroles']
 
-    for reactlink in reactlinks:
-        if reactlink['reactrole'] == role.id or reactlink['reactemoji'] == emoji:
-            await ctx.message.delete()
-            timeout_message = await ctx.send("Role or emoji already exists in data.")
-            await asyncio.sleep(5)
-            await timeout_message.delete()
-            return
+    if role.id in reactroles.emojis or emoji in reactroles.role_ids:
+        await ctx.message.delete()
+        await send_notice(ctx, "Role or emoji already exists in data.")
+        return
 
-    reactlinks.append({
-        'reactrole': role.id,
-        'reactemoji': emoji
-    })
+    reactroles.link(role.id, emoji)
 
-    save_data(data)
+    store.mark_dirty(ctx.guild.id, "reactlinks", role.id)
 
     await ctx.send(f"Reactlink added: | {emoji} | {role.mention}.")
 
@@ -1006,21 +3353,16 @@ async def unlink(ctx, role: discord.Role):
 
     """Unlink a role from an emoji"""
 
-    reactlinks = data['roles']['reactlinks']
+    reactroles = store.guild(ctx.guild.id)['reactroles']
 
-    role_exists = any(reactlink['reactrole'] == role.id for reactlink in reactlinks)
-    if not role_exists:
+    if role.id not in reactroles.emojis:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Role does not exist in reactlinks.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Role does not exist in reactlinks.")
         return
 
-    data['roles']['reactlinks'] = [
-        reactlink for reactlink in reactlinks if reactlink['reactrole'] != role.id
-    ]
+    reactroles.unlink(role.id)
 
-    save_data(data)
+    store.mark_dirty(ctx.guild.id, "reactlinks", role.id)
 
     await ctx.send(f"Reactlink removed for role: {role.mention}.")
 
@@ -1031,7 +3373,7 @@ async def list(ctx):
 
     """List roles linked to an emoji"""
 
-    reactlinks = data['roles']['reactlinks']
+    reactlinks = store.guild(ctx.guild.id)['roles']['reactlinks']
 
     if not reactlinks:
         await ctx.send("No reactlinks set up.")
@@ -1053,13 +3395,11 @@ async def clear(ctx):
 
     await ctx.message.delete()
 
-    data['roles']['reactlinks'] = []
+    store.guild(ctx.guild.id)['reactroles'].clear_links()
 
-    save_data(data)
+    store.mark_dirty(ctx.guild.id, "reactlinks")
 
-    timeout_message = await ctx.send("Reactlinks cleared.")
-    await asyncio.sleep(5)
-    await timeout_message.delete()
+    await send_notice(ctx, "Reactlinks cleared.")
 
 # Subcommand: mono --------------------------------------------------------------------------------
 
@@ -1084,25 +3424,19 @@ async def multi(ctx, *roles: discord.Role):
 # Handler: Reactrole logic ------------------------------------------------------------------------
 async def _handle_reactrole(ctx, roles, allow_multi):
 
-    reactlinks = data['roles']['reactlinks']
+    reactroles = store.guild(ctx.guild.id)['reactroles']
 
     if not roles:
-        timeout_message = await ctx.send("Please provide at least one role.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Please provide at least one role.")
         return
 
-    reactlinks = data['roles']['reactlinks']
-
-    valid_roles = {reactlink['reactrole']: reactlink['reactemoji'] for reactlink in reactlinks}
+    valid_roles = reactroles.emojis
 
     invalid_roles = [role.id for role in roles if role.id not in valid_roles]
 
     if invalid_roles:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Some provided roles are not eligible for reactlinks.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Some provided roles are not eligible for reactlinks.")
         return
 
     message_type = "multi" if allow_multi else "mono"
@@ -1125,11 +3459,9 @@ async def _handle_reactrole(ctx, roles, allow_multi):
     for emoji in ordered_roles:
         await message.add_reaction(emoji)
 
-    data['roles']['reactmessages'].append({
-        "messageID": message.id,
-        "type": message_type
-    })
-    save_data(data)
+    reactroles.add_message(message.id, message_type)
+    reaction_states.set(message.id, ordered_roles)
+    store.mark_dirty(ctx.guild.id, "reactmessages", message.id)
 
 # -------------------------------------------------------------------------------------------------
 # Command: Score
@@ -1142,9 +3474,7 @@ async def score_group(ctx):
 
     if ctx.invoked_subcommand is None:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Invalid subcommand.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Invalid subcommand.")
         return
 
 # Subcommand: set ---------------------------------------------------------------------------------
@@ -1157,30 +3487,26 @@ async def set_score(ctx, member: discord.Member, points: int):
 
     if points < 0:
         await ctx.message.delete()
-        timeout_message = await ctx.send("Points must be a positive value.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, "Points must be a positive value.")
         return
 
-    limit = config["score"]["limit"]
+    scores = store.guild(ctx.guild.id)["score"]
+    limit = scores.limit
 
     if points > limit:
         await ctx.message.delete()
-        timeout_message = await ctx.send(f"Points cannot exceed {limit}.")
-        await asyncio.sleep(5)
-        await timeout_message.delete()
+        await send_notice(ctx, f"Points cannot exceed {limit}.")
         return
 
-    user_scores = {entry["user"]: entry["points"] for entry in data["score"]}
     user_id = member.id
-    user_scores[user_id] = points
-    data["score"] = [{"user": user, "points": score} for user, score in user_scores.items()]
+    previous = scores.set(user_id, points)
 
-    save_data(data)
+    store.mark_dirty(ctx.guild.id, "score", user_id)
 
     await ctx.send(f"{member.mention} now has {points} points.")
 
-    await role_update()
+    if scores.crossed_threshold(previous, points):
+        role_update(ctx.guild.id, (user_id,))
 
 # Subcommand: view --------------------------------------------------------------------------------
 
@@ -1189,12 +3515,172 @@ async def view_score(ctx, member: discord.Member):
 
     """View member score"""
 
-    user_scores = {entry["user"]: entry["points"] for entry in data["score"]}
-    user_id = member.id
-    points = user_scores.get(user_id, 0)
+    points = store.guild(ctx.guild.id)["score"].get(member.id)
 
     await ctx.send(f"{member.mention} has {points} points.")
 
+# Subcommand: history -----------------------------------------------------------------------------
+
+@score_group.command(name='history')
+async def history_score(ctx, member: discord.Member, days: int = 30):
+
+    """View member score over the last days"""
+
+    scores = store.guild(ctx.guild.id)["score"]
+    days = max(1, min(days, scores.history.size))
+
+    values = scores.points_history(member.id, days)
+    points = scores.get(member.id)
+    limit = scores.limit
+    blocks = "▁▂▃▄▅▆▇█"
+    sparkline = "".join(blocks[min(value, limit) * (len(blocks) - 1) // limit] for value in values)
+
+    start = datetime.date.fromordinal(scores.today - days + 1)
+    end = datetime.date.fromordinal(scores.today)
+
+    await ctx.send(
+        f"{member.mention} over the last {days} days ({start} to {end}):\n\n"
+        f"``{sparkline}``\n\n"
+        f"Low: {min(values)} | High: {max(values)} | Now: {points}"
+    )
+
+# Subcommand: top ---------------------------------------------------------------------------------
+
+@score_group.command(name='top')
+async def top_score(ctx, amount: int = 10):
+
+    """View the leaderboard"""
+
+    amount = max(1, min(amount, 25))
+    leaders = store.guild(ctx.guild.id)["score"].top(amount)
+
+    if not leaders:
+        await ctx.send("No scores yet.")
+        return
+
+    leaderboard = "\n".join([
+        f"**{position}.** <@{user_id}> | {points} points"
+        for position, (user_id, points) in enumerate(leaders, start=1)
+    ])
+
+    await ctx.send(
+        "Leaderboard:\n\n" + leaderboard + "\n\nEnd of list",
+        allowed_mentions=discord.AllowedMentions.none()
+    )
+
+# Subcommand: rank --------------------------------------------------------------------------------
+
+@score_group.command(name='rank')
+async def rank_score(ctx, member: discord.Member):
+
+    """View member rank"""
+
+    scores = store.guild(ctx.guild.id)["score"]
+
+    if member.id not in scores:
+        await ctx.send(f"{member.mention} has no score yet.")
+        return
+
+    rank = scores.rank(member.id)
+    points = scores.get(member.id)
+
+    await ctx.send(
+        f"{member.mention} is ranked #{rank} of {len(scores)} with {points} points."
+    )
+
+# ----------------------------------------------------------------------------
+# Handler: Verification code expiry
+# ----------------------------------------------------------------------------
+
+class CodeExpiry:
+
+    """Expiration of the verification codes of every server, on a single timer
+
+    Codes are kept in a heap ordered by expiration. A replaced or used code leaves a stale
+    entry behind, which is skipped when it comes up and dropped when the heap is rebuilt."""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.heap = []
+        self.due = {}
+        self.handle = None
+
+    def load(self, guilds):
+
+        """Rebuild the heap from the stored expirations"""
+
+        self.due = {
+            (guild_id, user_id): user_data['expiration']
+            for guild_id, guild in guilds.items()
+            for user_id, user_data in guild["codes"].items()
+        }
+        self.heap = [(expiration, key) for key, expiration in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def schedule(self, guild_id, user_id, expiration):
+
+        """Expire the code of a member at a given time"""
+
+        key = (guild_id, user_id)
+        self.due[key] = expiration
+        heapq.heappush(self.heap, (expiration, key))
+
+        if len(self.heap) > 2 * len(self.due) + 1024:
+            self.heap = [(due, key) for key, due in self.due.items()]
+            heapq.heapify(self.heap)
+
+        if self.heap[0] == (expiration, key):
+            self.arm()
+
+    def cancel(self, guild_id, user_id):
+
+        """Forget the expiration of a code that was used"""
+
+        self.due.pop((guild_id, user_id), None)
+
+    def arm(self):
+
+        """Set the timer for the earliest expiration"""
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.heap:
+            delay = max(0, self.heap[0][0] - time.time())
+            self.handle = asyncio.get_running_loop().call_later(delay, self.sweep)
+
+    def sweep(self):
+
+        """Remove expired codes, one batch per loop iteration"""
+
+        self.handle = None
+        now = time.time()
+        count = 0
+
+        while self.heap and self.heap[0][0] <= now and count < self.batch_size:
+            expiration, key = heapq.heappop(self.heap)
+            count += 1
+
+            if self.due.get(key) != expiration:
+                continue
+
+            del self.due[key]
+            guild_id, user_id = key
+            codes = store.guild(guild_id)["codes"]
+
+            if user_id in codes:
+                codes.pop(user_id)
+                store.mark_dirty(guild_id, "codes", user_id)
+
+        if self.heap and self.heap[0][0] <= now:
+            self.handle = asyncio.get_running_loop().call_soon(self.sweep)
+        else:
+            self.arm()
+
+code_expiry = CodeExpiry(256)
+code_expiry.load(store.guilds)
+
 # ----------------------------------------------------------------------------
 # Command: Verify
 # ----------------------------------------------------------------------------
@@ -1207,35 +3693,32 @@ async def verify(ctx, email: str):
     await ctx.message.delete()
 
     try:
-        verified_role = ctx.guild.get_role(config['email']['VERIFIED_ROLE_ID'])
+        email_config = guild_config(ctx.guild.id, 'email')
+        verified_role = ctx.guild.get_role(email_config['VERIFIED_ROLE_ID'])
         if verified_role in ctx.author.roles:
-            timeout_message = await ctx.send('You are already verified.')
-            await asyncio.sleep(5)
-            await timeout_message.delete()
+            await send_notice(ctx, 'You are already verified.')
             return
 
-        if email.split('@')[-1] not in config['email']['ALLOWED_DOMAIN']:
-            timeout_message = await ctx.send('Domain name is not allowed!')
-            await asyncio.sleep(5)
-            await timeout_message.delete()
+        if email.split('@')[-1] not in email_config['ALLOWED_DOMAIN']:
+            await send_notice(ctx, 'Domain name is not allowed!')
             return
 
         code = str(random.randint(0, 999999)).zfill(6)
         user_id = str(ctx.author.id)
 
-        codes = data.get("codes", {})
+        codes = store.guild(ctx.guild.id)["codes"]
         codes[user_id] = {
             'code': code,
             'expiration': time.time() + 1800
         }
-        data["codes"] = codes
 
-        save_data(data)
+        store.mark_dirty(ctx.guild.id, "codes", user_id)
+        code_expiry.schedule(ctx.guild.id, user_id, codes[user_id]['expiration'])
 
         msg = EmailMessage()
         msg['Subject'] = f'Discord Verification Code: {code}'
-        sender_name = config['email']['EMAIL_NAME']
-        sender_email = config['email']['EMAIL_ADDRESS']
+        sender_name = email_config['EMAIL_NAME']
+        sender_email = email_config['EMAIL_ADDRESS']
         msg['From'] = f'{sender_name} <{sender_email}>'
         msg['To'] = email
 
@@ -1258,35 +3741,18 @@ async def verify(ctx, email: str):
         {sender_name}<br>
         ''', subtype='html')
 
-        with smtplib.SMTP(config['email']['SMTP_SERVER'], config['email']['SMTP_PORT']) as smtp:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.login(config['email']['EMAIL_ADDRESS'], config['email']['EMAIL_PASSWORD'])
-            smtp.send_message(msg)
+        with metrics.timer("smtp"):
+            with smtplib.SMTP(email_config['SMTP_SERVER'], email_config['SMTP_PORT']) as smtp:
+                smtp.ehlo()
+                smtp.starttls()
+                smtp.login(email_config['EMAIL_ADDRESS'], email_config['EMAIL_PASSWORD'])
+                smtp.send_message(msg)
 
-        timeout_message = await ctx.send('Verification code sent!')
-        await asyncio.sleep(5)
-        await timeout_message.delete()
-
-        await schedule_cleanup(user_id, code)
+        await send_notice(ctx, 'Verification code sent!')
 
     except Exception as error:
         print(f"An error occurred: {error}")
 
-async def schedule_cleanup(user_id, code):
-
-    """Cleanup codes"""
-
-    try:
-        await asyncio.sleep(1800)
-        codes = data.get("codes", {})
-        if user_id in codes and codes[user_id]['code'] == code:
-            codes.pop(user_id)
-            data["codes"] = codes
-            save_data(data)
-    except Exception as error:
-        print(f"An error occurred during cleanup: {error}")
-
 # ----------------------------------------------------------------------------
 # Command: Code
 # ----------------------------------------------------------------------------
@@ -1300,13 +3766,14 @@ async def code(ctx, user_code: str):
 
     try:
         member = ctx.author
-        unverified_role = ctx.guild.get_role(config['email']['UNVERIFIED_ROLE_ID'])
-        verified_role = ctx.guild.get_role(config['email']['VERIFIED_ROLE_ID'])
+        email_config = guild_config(ctx.guild.id, 'email')
+        unverified_role = ctx.guild.get_role(email_config['UNVERIFIED_ROLE_ID'])
+        verified_role = ctx.guild.get_role(email_config['VERIFIED_ROLE_ID'])
 
         if unverified_role in member.roles:
             user_id = str(member.id)
 
-            codes = data.get("codes", {})
+            codes = store.guild(ctx.guild.id)["codes"]
             user_data = codes.get(user_id)
 
             if user_data is not None:
@@ -1314,31 +3781,81 @@ async def code(ctx, user_code: str):
                 expiration_time = user_data.get('expiration')
 
                 if stored_code == user_code and time.time() < expiration_time:
-                    await member.remove_roles(unverified_role)
-                    await member.add_roles(verified_role)
-                    timeout_message = await ctx.send(
+                    role_queue.submit(
+                        member, add=(verified_role,), remove=(unverified_role,),
+                        priority="verification"
+                    )
+                    await send_notice(
+                        ctx,
                         f"Congratulations, {member.mention}! Your role has been verified."
                     )
-                    await asyncio.sleep(5)
-                    await timeout_message.delete()
                     codes.pop(user_id, None)
-                    data["codes"] = codes
-                    save_data(data)
+                    store.mark_dirty(ctx.guild.id, "codes", user_id)
+                    code_expiry.cancel(ctx.guild.id, user_id)
                 else:
                     await ctx.send("Invalid code or code has expired. Please check and try again.")
             else:
-                timeout_message = await ctx.send(
+                await send_notice(
+                    ctx,
                     "No verification data found for you. Please request a new code."
                 )
-                await asyncio.sleep(5)
-                await timeout_message.delete()
         else:
-            timeout_message = await ctx.send("You are already verified.")
-            await asyncio.sleep(5)
-            await timeout_message.delete()
+            await send_notice(ctx, "You are already verified.")
     except Exception as error:
         print(f"An error occurred: {error}")
 
+# -------------------------------------------------------------------------------------------------
+# Handler: Avatar cache
+# -------------------------------------------------------------------------------------------------
+
+class AvatarCache:
+
+    """Recently fetched avatars by URL, the least recently used dropped first
+
+    Avatar URLs contain the hash of the image, so a cached avatar never goes stale."""
+
+    def __init__(self, size):
+        self.size = size
+        self.avatars = OrderedDict()
+
+    async def fetch(self, session, url):
+
+        """Avatar image data, from the cache or downloaded"""
+
+        avatar_data = self.avatars.get(url)
+
+        if avatar_data is not None:
+            self.avatars.move_to_end(url)
+            metrics.count("avatar_cache_hits")
+            return avatar_data
+
+        metrics.count("avatar_cache_misses")
+
+        async with session.get(url) as response:
+            avatar_data = await response.read()
+
+            if response.status == 200:
+                self.avatars[url] = avatar_data
+                if len(self.avatars) > self.size:
+                    self.avatars.popitem(last=False)
+
+        return avatar_data
+
+avatar_cache = AvatarCache(config.get("interactions", {}).get("avatar_cache", 128))
+
+async def send_picture(ctx, path):
+
+    """Upload a duel/love picture after every more urgent call"""
+
+    with open(path, 'rb') as picture:
+        picture_data = picture.read()
+
+    await rest.submit(
+        "fun",
+        Route('POST', '/channels/{channel_id}/messages', channel_id=ctx.channel.id),
+        lambda: ctx.send(file=discord.File(BytesIO(picture_data), filename=path))
+    )
+
 # -------------------------------------------------------------------------------------------------
 # Command: Duel
 # -------------------------------------------------------------------------------------------------
@@ -1353,8 +3870,7 @@ async def duel(ctx, attacker: discord.Member, defender: discord.Member):
         duelist = config.get("interactions", {}).get("duelist", False)
 
         if not duelist:
-            with open('duel_refuse.gif', 'rb') as duel_refuse:
-                await ctx.send(file=discord.File(duel_refuse))
+            await send_picture(ctx, 'duel_refuse.gif')
             return
 
     async with aiohttp.ClientSession() as session:
@@ -1371,16 +3887,16 @@ async def duel(ctx, attacker: discord.Member, defender: discord.Member):
         for user in [attacker, defender]:
             avatar_url = user.guild_avatar.url if user.guild_avatar else user.avatar.url
 
-            async with session.get(avatar_url) as response:
-                avatar_data = await response.read()
-                avatar = Image.open(BytesIO(avatar_data))
-                avatar = avatar.resize(mask_size)
+            avatar_data = await avatar_cache.fetch(session, avatar_url)
+            avatar = Image.open(BytesIO(avatar_data))
+            avatar = avatar.resize(mask_size)
 
-                avatar = avatar.convert("RGBA")
-                avatar.putalpha(circular_mask)
+            avatar = avatar.convert("RGBA")
+            avatar.putalpha(circular_mask)
 
-                avatars.append(avatar)
+            avatars.append(avatar)
 
+        rendering = time.perf_counter()
         result_image = background.copy()
 
         result_image.paste(avatars[0], (0, 128), avatars[0])
@@ -1433,8 +3949,9 @@ async def duel(ctx, attacker: discord.Member, defender: discord.Member):
         result_image = Image.alpha_composite(result_image.convert("RGBA"), text_image)
 
         result_image.save("duel_result.png")
+        metrics.record("render:duel", time.perf_counter() - rendering)
 
-        await ctx.send(file=discord.File("duel_result.png"))
+        await send_picture(ctx, "duel_result.png")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Love
@@ -1449,8 +3966,7 @@ async def love(ctx, member_1: discord.Member, member_2: discord.Member):
     if bot_member in [member_1, member_2]:
         lover = config.get("interactions", {}).get("lover", False)
         if not lover:
-            with open('love_refuse.gif', 'rb') as love_refuse:
-                await ctx.send(file=discord.File(love_refuse))
+            await send_picture(ctx, 'love_refuse.gif')
             return
 
     async with aiohttp.ClientSession() as session:
@@ -1467,16 +3983,16 @@ async def love(ctx, member_1: discord.Member, member_2: discord.Member):
         for user in [member_1, member_2]:
             avatar_url = user.guild_avatar.url if user.guild_avatar else user.avatar.url
 
-            async with session.get(avatar_url) as response:
-                avatar_data = await response.read()
-                avatar = Image.open(BytesIO(avatar_data))
-                avatar = avatar.resize(mask_size)
+            avatar_data = await avatar_cache.fetch(session, avatar_url)
+            avatar = Image.open(BytesIO(avatar_data))
+            avatar = avatar.resize(mask_size)
 
-                avatar = avatar.convert("RGBA")
-                avatar.putalpha(circular_mask)
+            avatar = avatar.convert("RGBA")
+            avatar.putalpha(circular_mask)
 
-                avatars.append(avatar)
+            avatars.append(avatar)
 
+        rendering = time.perf_counter()
         result_image = background.copy()
 
         result_image.paste(avatars[0], (0, 128), avatars[0])
@@ -1525,8 +4041,9 @@ async def love(ctx, member_1: discord.Member, member_2: discord.Member):
         result_image.paste(text_image, (0, 20), text_image)
 
         result_image.save("love_result.png")
+        metrics.record("render:love", time.perf_counter() - rendering)
 
-        await ctx.send(file=discord.File("love_result.png"))
+        await send_picture(ctx, "love_result.png")
 
 # -------------------------------------------------------------------------------------------------
 # Command: Rate
@@ -1542,6 +4059,369 @@ async def rate(ctx, *, thing_to_rate):
 
     await ctx.send(f"*{thing_to_rate}*: **{rating}**/10\n\n{meter}")
 
+# -------------------------------------------------------------------------------------------------
+# Command: Stats
+# -------------------------------------------------------------------------------------------------
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+
+    """Show latency percentiles and counters"""
+
+    if not metrics.enabled:
+        await ctx.message.delete()
+        await send_notice(ctx, "Metrics are disabled.")
+        return
+
+    lines = [
+        f"**{name}** | {count} | "
+        f"p50 {p50 * 1000:.1f} ms | p95 {p95 * 1000:.1f} ms | p99 {p99 * 1000:.1f} ms"
+        for name, count, p50, p95, p99 in metrics.summary(20)
+    ]
+    lines += [f"**{name}** | {value}" for name, value in sorted(metrics.counters.items())]
+
+    if not lines:
+        await ctx.send("No stats yet.")
+        return
+
+    await ctx.send("Stats:\n\n" + "\n".join(lines)[:1900] + "\n\nEnd of list")
+
+def log_metrics(now):
+
+    """Print the busiest latencies and the counters on a single line"""
+
+    fields = [
+        f"{name} n={count} p50={p50 * 1000:.1f}ms p99={p99 * 1000:.1f}ms"
+        for name, count, p50, _, p99 in metrics.summary(5)
+    ]
+    fields += [f"{name}={value}" for name, value in sorted(metrics.counters.items())]
+
+    if fields:
+        print(f"Stats ({now.strftime('%Y-%m-%d %H:%M:%S')}): " + " | ".join(fields))
+
+def instrument_bot():
+
+    """Time every event handler, command and REST call"""
+
+    for name, handler in tuple(vars(bot).items()):
+        if name.startswith("on_") and asyncio.iscoroutinefunction(handler):
+            setattr(bot, name, metrics.timed(f"event:{name[3:]}")(handler))
+
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        ctx.command_started = time.perf_counter()
+
+    @bot.after_invoke
+    async def stop_command_timer(ctx):
+        metrics.record(
+            f"command:{ctx.command.qualified_name}", time.perf_counter() - ctx.command_started
+        )
+
+    request = bot.http.request
+
+    async def timed_request(route, **kwargs):
+        metrics.count("rest_calls")
+        started = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            metrics.record(f"rest:{route.method} {route.path}", time.perf_counter() - started)
+
+    bot.http.request = timed_request
+
+    scheduler.every("log_metrics", log_metrics, metrics_config.get("log_interval", 300))
+
+if metrics.enabled:
+    instrument_bot()
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Metrics endpoint
+# -------------------------------------------------------------------------------------------------
+
+class LoopLagProbe:
+
+    """Delay of the event loop, measured by how late a timer fires"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lag = 0.0
+        self.expected = None
+        self.handle = None
+
+    def start(self):
+
+        """Start probing (once)"""
+
+        if self.handle is None:
+            self.arm()
+
+    def arm(self):
+
+        """Set the next probe timer"""
+
+        loop = asyncio.get_running_loop()
+        self.expected = loop.time() + self.interval
+        self.handle = loop.call_at(self.expected, self.fire)
+
+    def fire(self):
+
+        """Record how late the timer fired"""
+
+        self.lag = max(0.0, asyncio.get_running_loop().time() - self.expected)
+        metrics.record("loop_lag", self.lag)
+        self.arm()
+
+def prometheus_value(value):
+
+    """Format a sample value for the Prometheus text format"""
+
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def prometheus_page():
+
+    """Every metric in the Prometheus text format"""
+
+    lines = []
+
+    def family(name, kind, description, samples):
+        lines.append(f"# HELP discordbot_{name} {description}")
+        lines.append(f"# TYPE discordbot_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"discordbot_{name}{labels} {prometheus_value(value)}")
+
+    family("loop_lag_seconds", "gauge", "Delay of the last event loop probe.", [
+        ("", loop_lag_probe.lag)
+    ])
+    family("gateway_latency_seconds", "gauge", "Gateway heartbeat latency.", [
+        ("", bot.latency)
+    ])
+    family("guilds", "gauge", "Servers with a database.", [("", len(store.guilds))])
+    family("store_pending_mutations", "gauge", "Database changes waiting for a write.", [
+        ("", store.mutations)
+    ])
+    family("role_queue_pending", "gauge", "Members with pending role changes.", [
+        ("", len(role_queue.pending))
+    ])
+    family("rest_pending", "gauge", "REST calls waiting for their priority or route.", [
+        (f'{{priority="{priority}"}}', count) for priority, count in rest.backlog().items()
+    ])
+    family("ingest_queue_depth", "gauge", "Messages waiting for their reward.", [
+        (f'{{guild="{guild_id}"}}', ingest.queue.qsize())
+        for guild_id, ingest in score_ingests.items()
+    ])
+    family("notices_pending", "gauge", "Bot notices waiting for their deletion.", [
+        ("", len(notices.heap))
+    ])
+    family("verification_codes_pending", "gauge", "Verification codes not expired yet.", [
+        ("", len(code_expiry.due))
+    ])
+
+    hits = metrics.counters.get("avatar_cache_hits", 0)
+    misses = metrics.counters.get("avatar_cache_misses", 0)
+    family("avatar_cache_hit_ratio", "gauge", "Share of avatar fetches served from the cache.", [
+        ("", hits / (hits + misses) if hits + misses else 0)
+    ])
+
+    for name, value in sorted(metrics.counters.items()):
+        family(f"{name}_total", "counter", f"Count of {name.replace('_', ' ')}.", [("", value)])
+
+    samples = []
+    for name, histogram in sorted(metrics.histograms.items()):
+        for quantile in (0.5, 0.95, 0.99):
+            samples.append(
+                (f'{{name="{name}",quantile="{quantile}"}}', histogram.percentile(quantile))
+            )
+        samples.append((f'_sum{{name="{name}"}}', histogram.sum))
+        samples.append((f'_count{{name="{name}"}}', histogram.total))
+    family("latency_seconds", "summary", "Latency of handlers, commands and writes.", samples)
+
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+
+    """Local HTTP listener serving /metrics"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def page(self, request):
+        return web.Response(text=prometheus_page(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+
+        """Start listening (once, and only if a port is set)"""
+
+        if self.runner is not None or not self.port:
+            return
+
+        application = web.Application()
+        application.router.add_get("/metrics", self.page)
+
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        print(f"Metrics served on http://{self.host}:{self.port}/metrics")
+
+loop_lag_probe = LoopLagProbe(metrics_config.get("loop_lag_interval", 1))
+metrics_server = MetricsServer(
+    metrics_config.get("http_host", "127.0.0.1"),
+    metrics_config.get("http_port", 0)
+)
+
+# -------------------------------------------------------------------------------------------------
+# Handler: Loop watchdog
+# -------------------------------------------------------------------------------------------------
+
+class LoopWatchdog:
+
+    """Thread sampling the stack of the event loop while a callback blocks it
+
+    The loop sets a heartbeat every interval. When the heartbeat is late by more than the
+    threshold, the watchdog samples the loop thread and counts the sample against the
+    running handler and the call site that blocks."""
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self.beat = time.monotonic()
+        self.loop_thread = None
+        self.handlers = {}
+        self.stalls = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+
+        """Start the heartbeat and the watchdog thread (once)"""
+
+        if self.thread is not None:
+            return
+
+        for name, handler in vars(bot).items():
+            if name.startswith("on_") and asyncio.iscoroutinefunction(handler):
+                self.handlers[getattr(handler, "__wrapped__", handler).__code__] = f"event:{name}"
+        for command in bot.walk_commands():
+            self.handlers[command.callback.__code__] = f"command:{command.qualified_name}"
+
+        self.loop_thread = threading.get_ident()
+        self.heartbeat()
+
+        self.thread = threading.Thread(target=self.watch, name="watchdog", daemon=True)
+        self.thread.start()
+
+    def heartbeat(self):
+
+        """Show that the loop is running (loop thread)"""
+
+        self.beat = time.monotonic()
+        asyncio.get_running_loop().call_later(self.interval, self.heartbeat)
+
+    def locate(self, frame):
+
+        """Name the handler running in a stack and the call site that blocks"""
+
+        handler = None
+        caller = None
+        code = frame.f_code
+        innermost = f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+
+        while frame is not None:
+            code = frame.f_code
+            if handler is None and code in self.handlers:
+                handler = self.handlers[code]
+            if caller is None and code.co_filename == __file__:
+                caller = f"main.py:{frame.f_lineno} {code.co_name}"
+            if handler is not None and caller is not None:
+                break
+            frame = frame.f_back
+
+        site = innermost if caller is None or caller == innermost else f"{caller} -> {innermost}"
+
+        return handler or "unknown", site
+
+    def watch(self):
+
+        """Sample the loop thread whenever the heartbeat is late (watchdog thread)"""
+
+        stalled_beat = None
+
+        while True:
+            time.sleep(self.interval)
+
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+
+            if blocked < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+
+            handler, site = self.locate(frame)
+            new_stall = beat != stalled_beat
+            stalled_beat = beat
+
+            with self.lock:
+                entry = self.stalls.setdefault((handler, site), [0, 0, 0.0])
+                entry[0] += new_stall
+                entry[1] += 1
+                entry[2] = max(entry[2], blocked)
+
+            if new_stall:
+                print(f"Event loop blocked for {blocked:.2f} s in {handler} at {site}")
+
+    def report(self, limit):
+
+        """Call sites that blocked the loop, as (handler, site, stalls, samples, longest)"""
+
+        with self.lock:
+            stalls = [(handler, site, *entry) for (handler, site), entry in self.stalls.items()]
+
+        return sorted(stalls, key=lambda stall: -stall[3])[:limit]
+
+watchdog_config = config.get("watchdog", {})
+loop_watchdog = LoopWatchdog(
+    watchdog_config.get("threshold", 0.25),
+    watchdog_config.get("interval", 0.05)
+)
+
+# -------------------------------------------------------------------------------------------------
+# Command: Stalls
+# -------------------------------------------------------------------------------------------------
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stalls(ctx):
+
+    """Show the calls that blocked the bot"""
+
+    if loop_watchdog.thread is None:
+        await ctx.message.delete()
+        await send_notice(ctx, "The watchdog is disabled.")
+        return
+
+    report = loop_watchdog.report(15)
+
+    if not report:
+        await ctx.send("No stalls yet.")
+        return
+
+    stall_list = "\n".join([
+        f"**{handler}** | ``{site}`` | {count} stalls | {samples} samples | longest {longest:.2f} s"
+        for handler, site, count, samples, longest in report
+    ])
+
+    await ctx.send("Stalls:\n\n" + stall_list[:1900] + "\n\nEnd of list")
+
 # -------------------------------------------------------------------------------------------------
 # Run the bot
 # -------------------------------------------------------------------------------------------------
@@ -1550,8 +4430,14 @@ async def main():
 
     """Start the bot using the async loop"""
 
-    await bot.start(TOKEN)
+    try:
+        await bot.start(TOKEN)
+    finally:
+        close_storage()
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    try:
+        loop.run_until_complete(main())
+    finally:
+        close_storage()
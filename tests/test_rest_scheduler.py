@@ -0,0 +1,221 @@
+"""REST scheduler against a local fake of the Discord API
+
+Run with "python -m pytest tests" or "python tests/test_rest_scheduler.py" from anywhere: the bot
+module is imported from the repository root, without connecting to Discord."""
+
+import os
+import sys
+import time
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+from discord.http import Route
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+from main import REST_PRIORITIES, RestScheduler
+
+# -------------------------------------------------------------------------------------------------
+# Fake API
+# -------------------------------------------------------------------------------------------------
+
+class FakeDiscord:
+
+    """Local HTTP server answering every path, with the rate limit headers of Discord"""
+
+    def __init__(self):
+        self.requests = []
+        self.limits = {}
+        self.delays = {}
+        self.runner = None
+        self.base = None
+        self.started = time.monotonic()
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.path, time.monotonic() - self.started))
+
+        # The query string overrides the delay and limits of the path for a single request
+        remaining, reset_after = self.limits.get(request.path, (5, 1))
+        remaining = int(request.query.get("remaining", remaining))
+        reset_after = float(request.query.get("reset_after", reset_after))
+        await asyncio.sleep(float(request.query.get("delay", self.delays.get(request.path, 0))))
+
+        headers = {
+            "X-RateLimit-Limit": "5",
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset-After": str(reset_after)
+        }
+        return web.json_response({"path": request.path}, headers=headers)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.base = f"http://{host}:{port}/api/v10"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def paths(self):
+        return [path for _, path, _ in self.requests]
+
+def call(fake, session, route, **query):
+
+    """A scheduled call sending the route to the fake API"""
+
+    async def request():
+        url = route.url.replace(Route.BASE, fake.base)
+        async with session.request(route.method, url, params=query) as response:
+            return await response.json()
+
+    return request
+
+def path(route):
+    return URL(route.url).path
+
+def channel_route(channel_id):
+    return Route('POST', '/channels/{channel_id}/messages', channel_id=channel_id)
+
+def member_route(user_id):
+    return Route('PATCH', '/guilds/{guild_id}/members/{user_id}', guild_id=1, user_id=user_id)
+
+def ban_route(user_id):
+    return Route('PUT', '/guilds/{guild_id}/bans/{user_id}', guild_id=1, user_id=user_id)
+
+def run(scenario, concurrency=8):
+
+    """Run a scenario with a fresh scheduler, fake API and traced session"""
+
+    async def runner():
+        fake = FakeDiscord()
+        await fake.start()
+        rest = RestScheduler(concurrency)
+
+        try:
+            async with aiohttp.ClientSession(trace_configs=[rest.trace]) as session:
+                return await scenario(fake, session, rest)
+        finally:
+            if rest.task is not None:
+                rest.task.cancel()
+            await fake.stop()
+
+    return asyncio.run(runner())
+
+# -------------------------------------------------------------------------------------------------
+# Tests
+# -------------------------------------------------------------------------------------------------
+
+def test_priority_order():
+
+    """Queued calls start by priority class, whatever their submission order"""
+
+    async def scenario(fake, session, rest):
+        futures = []
+        for channel_id, priority in enumerate(reversed(REST_PRIORITIES), start=1):
+            route = channel_route(channel_id)
+            futures.append(rest.submit(priority, route, call(fake, session, route)))
+
+        await asyncio.gather(*futures)
+        return fake.paths()
+
+    paths = run(scenario, concurrency=1)
+    assert paths == [
+        path(channel_route(channel_id)) for channel_id in range(len(REST_PRIORITIES), 0, -1)
+    ]
+
+def test_moderation_skips_concurrency():
+
+    """A ban starts while every slot is taken, other calls wait for a slot"""
+
+    async def scenario(fake, session, rest):
+        slow = member_route(1)
+        fake.delays[path(slow)] = 0.3
+
+        edit = rest.submit("roles", slow, call(fake, session, slow))
+        await asyncio.sleep(0.05)
+
+        log = rest.submit("logs", channel_route(1), call(fake, session, channel_route(1)))
+        ban = rest.submit("moderation", ban_route(2), call(fake, session, ban_route(2)))
+
+        await asyncio.gather(edit, log, ban)
+        return fake.requests
+
+    started = {request_path: at for _, request_path, at in run(scenario, concurrency=1)}
+    first = started[path(member_route(1))]
+    assert started[path(ban_route(2))] - first < 0.25
+    assert started[path(channel_route(1))] - first >= 0.25
+
+def test_duplicates_coalesced():
+
+    """Calls with the same key run once, with the latest call and the highest priority"""
+
+    async def scenario(fake, session, rest):
+        first = ban_route(3)
+        latest = ban_route(4)
+
+        queued = rest.submit("logs", first, call(fake, session, first), key=("ban", 1, 3))
+        merged = rest.submit("moderation", first, call(fake, session, latest), key=("ban", 1, 3))
+        assert merged is queued
+        assert rest.backlog()["moderation"] == 1 and rest.backlog()["logs"] == 0
+
+        result = await merged
+        return fake.paths(), result
+
+    paths, result = run(scenario)
+    assert paths == [path(ban_route(4))]
+    assert result["path"] == path(ban_route(4))
+
+def test_exhausted_route_held():
+
+    """A route out of calls waits for its reset, other routes keep going"""
+
+    async def scenario(fake, session, rest):
+        for user_id in (5, 6):
+            fake.limits[path(member_route(user_id))] = (0, 0.3)
+
+        first = rest.submit("roles", member_route(5), call(fake, session, member_route(5)))
+        await first
+
+        held = rest.submit("roles", member_route(6), call(fake, session, member_route(6)))
+        other = rest.submit("logs", channel_route(1), call(fake, session, channel_route(1)))
+
+        await asyncio.gather(held, other)
+        return fake.requests
+
+    started = {request_path: at for _, request_path, at in run(scenario)}
+    first = started[path(member_route(5))]
+    assert started[path(member_route(6))] - first >= 0.25
+    assert started[path(channel_route(1))] - first < 0.25
+
+def test_concurrent_responses_learned():
+
+    """Headers are read from every response of a path, not only the first call to end"""
+
+    async def scenario(fake, session, rest):
+        route = channel_route(7)
+        await rest.submit("logs", route, call(fake, session, route))
+
+        quick = rest.submit("logs", route, call(fake, session, route))
+        slow = rest.submit(
+            "logs", route, call(fake, session, route, delay=0.2, remaining=0, reset_after=0.5)
+        )
+        await asyncio.gather(quick, slow)
+
+        await rest.submit("logs", route, call(fake, session, route))
+        return fake.requests
+
+    started = [at for _, _, at in run(scenario)]
+    assert started[3] - max(started[1:3]) >= 0.6
+
+if __name__ == "__main__":
+    for name, test in tuple(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")